@@ -1,11 +1,16 @@
-from fastapi import Depends, APIRouter, HTTPException, Query
+from fastapi import Depends, APIRouter, HTTPException, Query, BackgroundTasks
 from database import engine, SessionLocal, Base, get_db
-import models, schemas, auth
-from sqlalchemy.orm import Session
+import models, schemas, auth, utils
+from sqlalchemy.orm import Session, joinedload, selectinload
 import crud
+import pool_metrics
+from read_routing import get_read_db
+from query_budget import max_queries
+import streaming
+from streaming import stream_format
 from typing import List, Optional
 from datetime import datetime, timedelta
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, or_, select
 import logging
 import json
 # Add these imports at the top
@@ -26,7 +31,7 @@ Base.metadata.create_all(engine)
 
 # === USER MANAGEMENT ===
 @router.get('/users/stats')
-def get_user_stats(db: Session = Depends(get_db), current_user=Depends(auth.check_admin)):
+def get_user_stats(db: Session = Depends(get_read_db), current_user=Depends(auth.check_admin)):
     """Get comprehensive user statistics"""
     total_users = db.query(models.User).count()
     patients = db.query(models.User).filter(models.User.role == models.UserRoles.PATIENT).count()
@@ -55,11 +60,24 @@ def get_user_stats(db: Session = Depends(get_db), current_user=Depends(auth.chec
 def get_all_users(
     role: Optional[str] = Query(None),
     page: int = Query(1, ge=1),
-    limit: int = Query(10, ge=1, le=100),
+    limit: Optional[int] = Query(None, ge=1, le=100),
     db: Session = Depends(get_db), 
-    current_user=Depends(auth.check_admin)
+    current_user=Depends(auth.check_admin),
+    fmt: Optional[str] = Depends(stream_format)
 ):
-    """Get paginated users with optional role filtering"""
+    """
+    Get paginated users with optional role filtering. Streamed (NDJSON/CSV)
+    responses are only paginated when limit is given, for full exports.
+    """
+    if fmt:
+        statement = select(models.User).order_by(models.User.id)
+        if role:
+            statement = statement.where(models.User.role == role)
+        if limit:
+            statement = statement.offset((page - 1) * limit).limit(limit)
+        return streaming.stream_query(db, statement, fmt, columns=list(schemas.UsersOut.model_fields), filename="users")
+
+    limit = limit or 10
     query = db.query(models.User)
     
     if role:
@@ -73,6 +91,7 @@ def get_all_users(
 @router.put('/users/{user_id}/toggle-status')
 def toggle_user_status(
     user_id: int, 
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db), 
     current_user=Depends(auth.check_admin)
 ):
@@ -85,6 +104,7 @@ def toggle_user_status(
     if hasattr(user, 'is_active'):
         user.is_active = not user.is_active
         db.commit()
+        background_tasks.add_task(crud.invalidate_principal, user_id)
         status = "activated" if user.is_active else "deactivated"
         return {"message": f"User {status} successfully", "user_id": user_id}
     else:
@@ -93,6 +113,7 @@ def toggle_user_status(
 @router.delete('/users/{user_id}')
 def delete_user(
     user_id: int, 
+    background_tasks: BackgroundTasks,
     current_user=Depends(auth.check_admin), 
     db: Session = Depends(get_db)
 ):
@@ -133,9 +154,10 @@ def delete_user(
         
         print(f"Deleted {family_connections_as_patient} patient connections and {family_connections_as_family} family connections")
         
-        # STEP 3: Delete family permissions
+        # STEP 3: Delete family permissions (granted by or to the user)
         family_permissions = db.query(models.FamilyPermissions).filter(
-            models.FamilyPermissions.family_member_id == user_id
+            or_(models.FamilyPermissions.patient_id == user_id,
+                models.FamilyPermissions.family_member_id == user_id)
         ).delete(synchronize_session=False)
         
         print(f"Deleted {family_permissions} family permissions")
@@ -185,14 +207,27 @@ def delete_user(
             models.ChatRoom.created_by == user_id
         ).delete(synchronize_session=False)
         
+        # Rooms the user is patient/doctor of but did not create stay for the
+        # other side; drop the reference, foreign keys are enforced
+        chat_rooms_as_patient = db.query(models.ChatRoom).filter(
+            models.ChatRoom.patient_id == user_id
+        ).update({models.ChatRoom.patient_id: None}, synchronize_session=False)
+
+        chat_rooms_as_doctor = db.query(models.ChatRoom).filter(
+            models.ChatRoom.doctor_id == user_id
+        ).update({models.ChatRoom.doctor_id: None}, synchronize_session=False)
+
         print(f"Deleted {messages_deleted} messages, {chat_participants_deleted} chat participants, {chat_rooms_deleted} chat rooms")
-        
+        print(f"Cleared user from {chat_rooms_as_patient} patient and {chat_rooms_as_doctor} doctor chat rooms")
+
         # STEP 8: Finally delete the user
         print(f"Deleting user: {user.name} ({user.email})")
         db.delete(user)
         
         # Commit all changes
         db.commit()
+        # cached principals would keep the deleted user's tokens working
+        background_tasks.add_task(crud.invalidate_principal, user_id)
         
         return {
             'message': f'User "{user.name}" and all related data deleted successfully',
@@ -280,9 +315,35 @@ def get_user_details(
         }
     }
 
+# === DOCTOR SCHEDULES ===
+@router.put('/availability/bulk')
+def bulk_set_availability(
+    request: schemas.BulkAvailabilityRequest,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    current_user=Depends(auth.check_admin)
+):
+    """Replace the weekly schedules of many doctors at once (e.g. onboarding a clinic)"""
+    doctor_ids = {schedule.doctor_id for schedule in request.schedules}
+    found = {doctor_id for (doctor_id,) in db.query(models.User.id).filter(
+        models.User.id.in_(doctor_ids),
+        models.User.role == models.UserRoles.DOCTOR
+    )}
+    missing = sorted(doctor_ids - found)
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Doctors not found: {missing}")
+
+    changes = crud.bulk_set_availability(request, db)
+    if changes:
+        background_tasks.add_task(crud.availability_changed, changes)
+    return {
+        "message": "Availability updated",
+        "changed": [{"doctor_id": doctor_id, "day_of_week": day_of_week} for doctor_id, day_of_week in changes]
+    }
+
 # === APPOINTMENT MANAGEMENT ===
 @router.get('/appointments/stats')
-def get_appointment_stats(db: Session = Depends(get_db), current_user=Depends(auth.check_admin)):
+def get_appointment_stats(db: Session = Depends(get_read_db), current_user=Depends(auth.check_admin)):
     """Get appointment statistics"""
     total = db.query(models.Appointments).count()
     pending = db.query(models.Appointments).filter(models.Appointments.status == 'PENDING').count()
@@ -291,9 +352,11 @@ def get_appointment_stats(db: Session = Depends(get_db), current_user=Depends(au
     completed = db.query(models.Appointments).filter(models.Appointments.status == 'COMPLETED').count()
     
     # Today's appointments
-    today = datetime.utcnow().date()
+    # half-open range instead of func.date(date_time) so the date_time index can be used
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
     today_appointments = db.query(models.Appointments).filter(
-        func.date(models.Appointments.date_time) == today
+        models.Appointments.date_time >= today,
+        models.Appointments.date_time < today + timedelta(days=1)
     ).count()
     
     return {
@@ -308,6 +371,7 @@ def get_appointment_stats(db: Session = Depends(get_db), current_user=Depends(au
     }
 
 @router.get('/appointments')
+@max_queries(2)
 def get_all_appointments(
     status: Optional[str] = Query(None),
     page: int = Query(1, ge=1),
@@ -320,6 +384,9 @@ def get_all_appointments(
         # Use correct model name 'Appointments'
         query = db.query(models.Appointments).join(
             models.User, models.Appointments.patient_id == models.User.id
+        ).options(
+            joinedload(models.Appointments.patient),
+            joinedload(models.Appointments.doctor)
         )
         
         if status:
@@ -336,10 +403,7 @@ def get_all_appointments(
         
         result = []
         for apt in appointments:
-            # Get patient and doctor details
-            patient = db.query(models.User).filter(models.User.id == apt.patient_id).first()
-            doctor = db.query(models.User).filter(models.User.id == apt.doctor_id).first()
-            
+            patient, doctor = apt.patient, apt.doctor
             result.append({
                 "id": apt.id,
                 "patient_name": patient.name if patient else "Unknown",
@@ -356,25 +420,19 @@ def get_all_appointments(
 
 
 @router.get('/chats', response_model=List[dict])
+@max_queries(4)
 def get_all_chats(db: Session = Depends(get_db), current_user=Depends(auth.check_admin)):
     """Get all chat rooms with participant details - FINAL FIX"""
-    chats = db.query(models.ChatRoom).all()
+    chats = db.query(models.ChatRoom).options(selectinload(models.ChatRoom.participants)).all()
+    # ChatParticipant has no user relationship: fetch every participant's user in one query
+    user_ids = {participant.user_id for chat in chats for participant in chat.participants}
+    users = {user.id: user for user in db.query(models.User).filter(models.User.id.in_(user_ids))} if user_ids else {}
     
     result = []
     for chat in chats:
-        # Get participants for this chat
-        participants = db.query(models.ChatParticipant).filter(
-            models.ChatParticipant.chat_id == chat.id
-        ).all()
-        
-        # Get user data for each participant (FIXED)
         participant_data = []
-        for participant in participants:
-            # Query user separately since relationship is not working
-            user = db.query(models.User).filter(
-                models.User.id == participant.user_id
-            ).first()
-            
+        for participant in chat.participants:
+            user = users.get(participant.user_id)
             if user:
                 participant_data.append({
                     "id": user.id,
@@ -457,6 +515,16 @@ def system_health_check(db: Session = Depends(get_db), current_user=Depends(auth
         "timestamp": datetime.utcnow()
     }
 
+@router.get('/system/db-pool')
+def db_pool_metrics(current_user=Depends(auth.check_admin)):
+    """Connection pool telemetry of the worker serving this request"""
+    return pool_metrics.snapshot()
+
+@router.get('/system/password-pool')
+def password_pool_metrics(current_user=Depends(auth.check_admin)):
+    """bcrypt process pool load of the worker serving this request"""
+    return utils.password_pool.stats()
+
 class SystemSettings(BaseModel):
     max_appointments_per_day: int = 50
     appointment_booking_advance_days: int = 30
@@ -470,7 +538,7 @@ current_settings = SystemSettings()
 @router.get('/analytics/overview')
 def get_analytics_overview(
     days: int = Query(30, ge=1, le=365),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user=Depends(auth.check_admin)
 ):
     """Get analytics overview - FIXED MODEL NAMES"""
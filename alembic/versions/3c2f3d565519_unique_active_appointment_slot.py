@@ -0,0 +1,37 @@
+"""Unique active appointment per doctor slot
+
+Revision ID: 3c2f3d565519
+Revises: 879560814289
+Create Date: 2026-10-17 09:12:41.530112
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c2f3d565519'
+down_revision: Union[str, None] = '879560814289'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ACTIVE_APPOINTMENT_WHERE = "status IN ('PENDING', 'ACCECPTED')"
+
+
+def upgrade() -> None:
+    # Fails if the table already holds two active appointments for the same
+    # doctor and time; reject the duplicates before running this migration.
+    op.create_index(
+        'uq_appointments_active_slot',
+        'appointments',
+        ['doctor_id', 'date_time'],
+        unique=True,
+        postgresql_where=sa.text(ACTIVE_APPOINTMENT_WHERE),
+        sqlite_where=sa.text(ACTIVE_APPOINTMENT_WHERE),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('uq_appointments_active_slot', table_name='appointments')
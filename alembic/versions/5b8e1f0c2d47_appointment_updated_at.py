@@ -0,0 +1,29 @@
+"""Appointment updated_at for calendar revalidation
+
+Revision ID: 5b8e1f0c2d47
+Revises: 3c2f3d565519
+Create Date: 2026-10-17 11:02:18.204617
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8e1f0c2d47'
+down_revision: Union[str, None] = '3c2f3d565519'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'appointments',
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('appointments', 'updated_at')
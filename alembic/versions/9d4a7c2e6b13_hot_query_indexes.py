@@ -0,0 +1,45 @@
+"""Composite indexes for hot queries
+
+Revision ID: 9d4a7c2e6b13
+Revises: 5b8e1f0c2d47
+Create Date: 2026-10-17 13:40:05.118342
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4a7c2e6b13'
+down_revision: Union[str, None] = '5b8e1f0c2d47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_appointments_doctor_id_date_time', 'appointments', ['doctor_id', 'date_time']),
+    ('ix_appointments_patient_id_date_time', 'appointments', ['patient_id', 'date_time']),
+    ('ix_vitals_patient_id_timestamp', 'vitals', ['patient_id', 'timestamp']),
+    ('ix_chat_messages_chat_id_timestamp', 'chat_messages', ['chat_id', 'timestamp']),
+    ('ix_chat_participants_user_id', 'chat_participants', ['user_id']),
+    ('ix_family_connections_family_member_id', 'family_connections', ['family_member_id']),
+    ('ix_family_permissions_family_member_id', 'family_permissions', ['family_member_id']),
+    ('ix_doctor_availability_doctor_id_day_of_week', 'doctor_availability', ['doctor_id', 'day_of_week']),
+]
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY doesn't lock writes but can't run inside a
+    # transaction. A failed concurrent build leaves an INVALID index behind;
+    # drop it before re-running (if_not_exists would skip it).
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
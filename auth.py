@@ -2,10 +2,16 @@ from jose import jwt, JWTError
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
+from starlette.concurrency import run_in_threadpool
 import models
 from sqlalchemy.orm import Session
 from database import get_db
 import os
+import secrets
+import time as t
+import principal_cache
+import token_cache
+import main
 
 oauth2_schema = OAuth2PasswordBearer(tokenUrl='token')
 
@@ -16,7 +22,9 @@ ACCESS_TOKEN_EXPIRE_TIME = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 def create_access_token(data : dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_TIME)
-    to_encode.update({'exp' : expire})
+    # iat for per-user revocation, jti to revoke this one token (token_cache.py). iat keeps
+    # its fraction so a login in the same second as a revocation is not caught by it
+    to_encode.update({'exp' : expire, 'iat' : t.time(), 'jti' : secrets.token_hex(16)})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 def decode_token(token : str = Depends(oauth2_schema)):
@@ -30,16 +38,71 @@ def decode_token(token : str = Depends(oauth2_schema)):
         raise HTTPException(status_code=401, detail="Token is invalid or expired")
     
     
-def get_current_user(token: str = Depends(oauth2_schema), db: Session = Depends(get_db)):
+def decode_claims(token : str) -> dict:
+    """Claims of a token with a valid signature; tokens verified before come from token_cache."""
+    payload = token_cache.cache.get(token)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("id")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
     except JWTError:
         raise HTTPException(status_code=401, detail="Token is invalid or expired")
+    if payload.get("id") is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    token_cache.cache.put(token, payload)
+    return payload
 
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+
+async def verify_claims(token : str) -> dict:
+    """decode_claims, and reject tokens revoked by logout or an account change."""
+    payload = decode_claims(token)
+    if await token_cache.is_revoked(main.redis_client, payload):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return payload
+
+
+class Principal:
+    """Who the token was issued to, as of login: id, role and email (sub)."""
+    __slots__ = ("id", "role", "email")
+
+    def __init__(self, id : int, role, email : str):
+        self.id = id
+        self.role = models.UserRoles(role)
+        self.email = email
+
+
+async def get_principal(token: str = Depends(oauth2_schema)) -> Principal:
+    """
+    The caller from the verified token claims alone, no database lookup.
+    Routes that need the user's current state use get_current_user.
+    """
+    claims = await verify_claims(token)
+    try:
+        return Principal(int(claims["id"]), claims.get("role"), claims.get("sub"))
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+
+async def get_current_user(token: str = Depends(oauth2_schema), db: Session = Depends(get_db)):
+    """The models.User row of the token's user, loaded on every request."""
+    user_id = (await verify_claims(token))["id"]
+
+    user = await run_in_threadpool(lambda: db.query(models.User).filter(models.User.id == user_id).first())
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+
+async def get_cached_user(token: str = Depends(oauth2_schema), db: Session = Depends(get_db)):
+    """
+    get_current_user through principal_cache: a CachedUser (id, role, name,
+    email) that is usually served without a query. For routes that read
+    nothing else of the user.
+    """
+    user_id = (await verify_claims(token))["id"]
+
+    load = lambda: run_in_threadpool(lambda: db.query(models.User).filter(models.User.id == user_id).first())
+    user = await principal_cache.get_principal(main.redis_client, int(user_id), load)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
@@ -63,4 +126,18 @@ def check_family(user = Depends(get_current_user)):
 def check_admin(user = Depends(get_current_user)):
     if user.role == 'admin':
         return user
-    raise HTTPException(401, 'only admin can access')
\ No newline at end of file
+    raise HTTPException(401, 'only admin can access')
+
+
+def require_role(role : models.UserRoles, message : str):
+    """Role guard on the token claims, the zero-query counterpart of check_doctor & co."""
+    def guard(principal : Principal = Depends(get_principal)):
+        if principal.role == role:
+            return principal
+        raise HTTPException(401, message)
+    return guard
+
+doctor_claims = require_role(models.UserRoles.DOCTOR, 'only doctor can view')
+patient_claims = require_role(models.UserRoles.PATIENT, 'only patient can view')
+family_claims = require_role(models.UserRoles.FAMILY, 'only family can view')
+admin_claims = require_role(models.UserRoles.ADMIN, 'only admin can access')
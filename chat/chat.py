@@ -1,20 +1,25 @@
 # routers/chat.py
 from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, Query
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
 from typing import List, Dict
 from jose import jwt, JWTError
 import models
 import schemas as schemas  # or import from your main schemas.py
-from database import get_db
+from database import get_db, get_async_db
+from read_routing import get_read_db
 import auth
 from datetime import datetime
 
 from chat.chat_auth import WS_SECRET_KEY, WS_ALGORITHM  # uses WS_SECRET_KEY defined there
+from fanout import FanoutHub
 
 router = APIRouter(prefix="/chats", tags=["chats"])
 
 # In-memory connections per chat_id (for a single worker). Use Redis in production.
-connections: Dict[int, List[WebSocket]] = {}
+# Each socket gets its own outbound queue + writer, so a slow client can't hold up the room.
+connections = FanoutHub()
 
 def _decode_ws_token(ws_token: str):
     try:
@@ -138,7 +143,7 @@ def create_chat_room_with_emails(
 # Update your existing /chats/my endpoint
 @router.get('/my')
 def get_my_chats(
-    current_user = Depends(auth.get_current_user),
+    current_user = Depends(auth.get_cached_user),
     db: Session = Depends(get_db)
 ):
     """Get chat rooms - includes family member access"""
@@ -225,7 +230,7 @@ def get_my_chats(
 @router.get('/family')
 def get_my_chats(
     patient_id: int = Query(..., description="Patient ID to filter chat rooms"),
-    current_user=Depends(auth.get_current_user),
+    current_user=Depends(auth.get_cached_user),
     db: Session = Depends(get_db),
 ):
     if current_user.role == models.UserRoles.FAMILY:
@@ -276,7 +281,7 @@ def get_my_chats(
 
 
 @router.get("/{chat_id}/messages", response_model=List[schemas.ChatMessageOut])
-def get_chat_messages(chat_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def get_chat_messages(chat_id: int, db: Session = Depends(get_db), read_db: Session = Depends(get_read_db), current_user = Depends(auth.get_cached_user)):
     # ensure membership
     participant = db.query(models.ChatParticipant).filter(
         models.ChatParticipant.chat_id == chat_id,
@@ -316,12 +321,14 @@ def get_chat_messages(chat_id: int, db: Session = Depends(get_db), current_user:
     elif not participant:
         raise HTTPException(status_code=403, detail="Not a member of this chat")
 
-    messages = db.query(models.ChatMessage).filter(models.ChatMessage.chat_id == chat_id).order_by(models.ChatMessage.timestamp).all()
+    # membership is checked (and family members added) on the primary, the history is read from a replica
+    messages = read_db.query(models.ChatMessage).options(
+        joinedload(models.ChatMessage.sender)
+    ).filter(models.ChatMessage.chat_id == chat_id).order_by(models.ChatMessage.timestamp).all()
 
     out = []
     for m in messages:
-        sender = db.query(models.User).filter(models.User.id == m.sender_id).first()
-        sender_name = sender.name if sender else "Unknown"
+        sender_name = m.sender.name if m.sender else "Unknown"
         out.append(schemas.ChatMessageOut(
             id=m.id,
             chat_id=m.chat_id,
@@ -333,7 +340,7 @@ def get_chat_messages(chat_id: int, db: Session = Depends(get_db), current_user:
     return out
 
 @router.websocket("/ws/{chat_id}")
-async def websocket_chat(websocket: WebSocket, chat_id: int, ws_token: str = Query(...), db: Session = Depends(get_db)):
+async def websocket_chat(websocket: WebSocket, chat_id: int, ws_token: str = Query(...), db: AsyncSession = Depends(get_async_db)):
     """
     Connect with: ws://host/chats/ws/{chat_id}?ws_token=<short_token>
     The short-lived token is generated by POST /ws-token
@@ -346,28 +353,28 @@ async def websocket_chat(websocket: WebSocket, chat_id: int, ws_token: str = Que
         return
 
     # check membership - Updated to handle family members
-    participant = db.query(models.ChatParticipant).filter(
+    participant = (await db.scalars(select(models.ChatParticipant).where(
         models.ChatParticipant.chat_id == chat_id,
         models.ChatParticipant.user_id == user_id
-    ).first()
+    ).limit(1))).first()
+    user = await db.get(models.User, user_id)
     
     if not participant:
         # If not a direct participant, check if family member with permissions
-        user = db.query(models.User).filter(models.User.id == user_id).first()
         if user and user.role == models.UserRoles.FAMILY:
             # Check if family has access to this chat's patient
-            chat_room = db.query(models.ChatRoom).filter(models.ChatRoom.id == chat_id).first()
+            chat_room = await db.get(models.ChatRoom, chat_id)
             if chat_room and chat_room.patient_id:
-                family_connection = db.query(models.FamilyConnections).filter(
+                family_connection = (await db.scalars(select(models.FamilyConnections).where(
                     models.FamilyConnections.patient_id == chat_room.patient_id,
                     models.FamilyConnections.family_member_id == user_id
-                ).first()
+                ).limit(1))).first()
                 
                 if family_connection:
                     # Check permissions
-                    permissions = db.query(models.FamilyPermissions).filter(
+                    permissions = (await db.scalars(select(models.FamilyPermissions).where(
                         models.FamilyPermissions.family_member_id == user_id
-                    ).first()
+                    ).limit(1))).first()
                     
                     permission_list = permissions.permissions if permissions else []
                     
@@ -378,7 +385,7 @@ async def websocket_chat(websocket: WebSocket, chat_id: int, ws_token: str = Que
                             user_id=user_id
                         )
                         db.add(new_participant)
-                        db.commit()
+                        await db.commit()
                     else:
                         await websocket.close(code=1008, reason="No permission")
                         return
@@ -392,10 +399,14 @@ async def websocket_chat(websocket: WebSocket, chat_id: int, ws_token: str = Que
             await websocket.close(code=1008, reason="Not a member")
             return
 
+    sender_name = user.name if user else "Unknown"
+    # end the read transaction so the socket doesn't hold a pooled connection while idle
+    await db.commit()
+
     # accept and register
     await websocket.accept()
     chat_id_int = int(chat_id)
-    connections.setdefault(chat_id_int, []).append(websocket)
+    connections.subscribe(chat_id_int, websocket)
 
     try:
         while True:
@@ -407,11 +418,7 @@ async def websocket_chat(websocket: WebSocket, chat_id: int, ws_token: str = Que
             # save message
             msg = models.ChatMessage(chat_id=chat_id_int, sender_id=user_id, content=content)
             db.add(msg)
-            db.commit()
-            db.refresh(msg)
-            
-            sender = db.query(models.User).filter(models.User.id == msg.sender_id).first()
-            sender_name = sender.name if sender else "Unknown"
+            await db.commit()
 
             payload = {
                 "id": msg.id,
@@ -422,21 +429,14 @@ async def websocket_chat(websocket: WebSocket, chat_id: int, ws_token: str = Que
                 "timestamp": msg.timestamp.isoformat()
             }
 
-            # broadcast to all connections in this chat
-            conns = list(connections.get(chat_id_int, []))
-            for conn in conns:
-                try:
-                    await conn.send_json(payload)
-                except:
-                    pass
+            # queue for every connection in this chat; failed sockets are evicted by their writer
+            connections.publish([chat_id_int], payload)
 
     except WebSocketDisconnect:
-        if websocket in connections.get(chat_id_int, []):
-            connections[chat_id_int].remove(websocket)
+        connections.unsubscribe(chat_id_int, websocket)
     except Exception:
         # ensure cleanup
-        if websocket in connections.get(chat_id_int, []):
-            connections[chat_id_int].remove(websocket)
+        connections.unsubscribe(chat_id_int, websocket)
         try:
             await websocket.close()
         except:
@@ -20,7 +20,7 @@ WS_ALGORITHM = getattr(auth, "WS_ALGORITHM", "HS256")
 WS_TOKEN_EXPIRE_SECONDS = 60  # short-lived
 
 @router.post("/ws-token")
-def generate_ws_token(current_user = Depends(auth.get_current_user)):
+def generate_ws_token(current_user = Depends(auth.get_cached_user)):
     """
     Returns a short-lived token for WebSocket authentication.
     Frontend should POST here with Authorization: Bearer <jwt>
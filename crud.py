@@ -1,10 +1,22 @@
-from sqlite3 import IntegrityError
 from sqlalchemy.orm import session
-from sqlalchemy import func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import case, func, text, insert, update, delete, select
+from sqlalchemy.dialects import postgresql, sqlite
 import models, schemas
 from datetime import datetime, time, timedelta
+from collections import defaultdict
+import heapq
+import itertools
 import hashlib
 import main
+import slot_index
+import slot_holds
+import slot_cache
+import principal_cache
+import refresh_tokens
+import token_cache
+import auth
+from slot_holds import make_slot_key
 
 def insert_patient(db : session, user : schemas.InsertPatient):
     patient = models.User(
@@ -82,37 +94,39 @@ def get_all_doctors(db : session):
 #     db.refresh(create_appointment)
 #     return create_appointment
 
-def book_appointment(db: session, appointment: schemas.BookAppointment, patient_id: int):
-    try:
-        db_appointment = models.Appointments(
-        patient_id = patient_id,
-        doctor_id = appointment.doctor_id,
-        date_time = appointment.appointment_date,
-        status = models.Status.PENDING
-    )
-        db.add(db_appointment)
-        db.commit()
-        db.refresh(db_appointment)
-        return db_appointment
-    except IntegrityError as e:
-        db.rollback()
-        print(f"❌ Database integrity error: {e}")
-        if "duplicate key" in str(e).lower():
-            # Attempt to fix sequence and retry once
-            db.execute(text("SELECT setval('appointments_id_seq', (SELECT MAX(id) FROM appointments))"))
-            db.commit()
-            
-            db_appointment = models.Appointments(
+def _booking_insert(dialect_name : str, appointment : schemas.BookAppointment, patient_id : int):
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    return insert(models.Appointments).values(
         patient_id = patient_id,
         doctor_id = appointment.doctor_id,
         date_time = appointment.appointment_date,
         status = models.Status.PENDING
-    )
-            db.add(db_appointment)
-            db.commit()
-            db.refresh(db_appointment)
-            return db_appointment
-        raise e
+    ).on_conflict_do_nothing(
+        index_elements = ['doctor_id', 'date_time'],
+        index_where = text(models.ACTIVE_APPOINTMENT_WHERE)
+    ).returning(models.Appointments)
+
+def book_appointment(db: session, appointment: schemas.BookAppointment, patient_id: int):
+    """
+    Insert the appointment in one round trip. The partial unique index on
+    (doctor_id, date_time) for active statuses turns a concurrent double booking
+    into ON CONFLICT DO NOTHING, in which case None is returned.
+    """
+    stmt = _booking_insert(db.bind.dialect.name, appointment, patient_id)
+    db_appointment = db.scalars(stmt).first()
+    if db_appointment is not None:
+        # keep the RETURNING values instead of expiring them on commit and reloading
+        db.expunge(db_appointment)
+    db.commit()
+    return db_appointment
+
+
+async def async_book_appointment(db: AsyncSession, appointment: schemas.BookAppointment, patient_id: int):
+    """book_appointment for async routes."""
+    stmt = _booking_insert(db.bind.dialect.name, appointment, patient_id)
+    db_appointment = (await db.scalars(stmt)).first()
+    await db.commit()
+    return db_appointment
 
 
 def appointment_response(db : session, response : schemas.AppointmentResponse):
@@ -166,96 +180,217 @@ def appointment_response(db : session, response : schemas.AppointmentResponse):
 #     db.refresh(doctor_availability)
 #     return doctor_availability
 
+AVAILABILITY_FIELDS = ('start_time', 'end_time', 'appointment_duration', 'break_start', 'break_end')
+
+def apply_availability_diff(db : session, schedules : dict, replace_week : bool = True):
+    """
+    schedules: {doctor_id: {day_of_week: {field: value for AVAILABILITY_FIELDS}}}
+    Diffs against the doctors' current rows and writes only what differs, with one
+    INSERT, UPDATE and DELETE statement each, in a single transaction. With
+    replace_week, weekdays missing from a doctor's schedule are removed.
+    Returns the sorted (doctor_id, day_of_week) pairs that changed.
+    """
+    existing = defaultdict(list)
+    for row in db.query(models.DoctorAvailability).filter(
+        models.DoctorAvailability.doctor_id.in_(schedules.keys())
+    ).order_by(models.DoctorAvailability.id):
+        existing[(row.doctor_id, row.day_of_week)].append(row)
+
+    inserts, updates, delete_ids, changed = [], [], [], set()
+    for doctor_id, week in schedules.items():
+        for day_of_week, values in week.items():
+            rows = existing.pop((doctor_id, day_of_week), [])
+            if not rows:
+                inserts.append({"doctor_id": doctor_id, "day_of_week": day_of_week, "is_active": True, **values})
+                changed.add((doctor_id, day_of_week))
+                continue
+            row, duplicates = rows[0], rows[1:]
+            delete_ids += [duplicate.id for duplicate in duplicates]
+            if duplicates or not row.is_active or any(getattr(row, field) != values[field] for field in AVAILABILITY_FIELDS):
+                updates.append({"id": row.id, "is_active": True, **values})
+                changed.add((doctor_id, day_of_week))
+
+    if replace_week:
+        for pair, rows in existing.items():
+            delete_ids += [row.id for row in rows]
+            changed.add(pair)
+
+    if inserts:
+        db.execute(insert(models.DoctorAvailability), inserts)
+    if updates:
+        db.execute(update(models.DoctorAvailability), updates)
+    if delete_ids:
+        db.execute(delete(models.DoctorAvailability).where(models.DoctorAvailability.id.in_(delete_ids)))
+    db.commit()
+    return sorted(changed)
+
+def availability_values(item : schemas.DoctorAvailability):
+    return {field: getattr(item, field) for field in AVAILABILITY_FIELDS}
+
 def set_doctor_availability(
     request: schemas.SetAvailabilityRequest, 
     doctor_id: int,
     db: session
 ):
-    # First delete existing availability entries for doctor
-    db.query(models.DoctorAvailability).filter(
-        models.DoctorAvailability.doctor_id == doctor_id
-    ).delete()
-
-    # Add all new availabilities
-    for item in request.availabilities:
-        doctor_availability = models.DoctorAvailability(
-            doctor_id=doctor_id,
-            day_of_week=item.day_of_week,
-            start_time=item.start_time,
-            end_time=item.end_time,
-            appointment_duration=item.appointment_duration,
-            break_start=item.break_start,
-            break_end=item.break_end
-        )
-        db.add(doctor_availability)
-
-    db.commit()
+    apply_availability_diff(db, {doctor_id: {item.day_of_week: availability_values(item) for item in request.availabilities}})
 
     # Optionally return all current availabilities for confirmation
     return db.query(models.DoctorAvailability).filter(
         models.DoctorAvailability.doctor_id == doctor_id
     ).all()
 
-
-async def get_doctor_free_slots(doctor_id : int, date : datetime, db : session):
-    accepted_appointments = db.query(models.Appointments).filter(models.Appointments.doctor_id == doctor_id,
-                                          func.date(models.Appointments.date_time) == date,
-                                          models.Appointments.status.in_(['ACCECPTED', 'PENDING'])).all()
-
-    
-    pattern = f"slot_hold:doctor:{doctor_id}:{date.isoformat()}T*"
-    held_keys = await main.redis_client.keys(pattern)
-    held_times = set()
-    for key in held_keys:
-        if isinstance(key, bytes):
-            key = key.decode()
-        _, _, _, iso_dt = key.split(":", 3)
-        dt = datetime.fromisoformat(iso_dt)
-        held_times.add(dt.time())
-    
-    un_available_slots = [slot.date_time.time() for slot in accepted_appointments]
-
-    day_to_num = {'Sunday' : 0, 'Monday' : 1, 'Tuesday' : 2, 'Wednesday' : 3, 'Thursday' : 4, 'Friday' : 5, 'Saturday' : 6}
-
-    day_num = day_to_num[date.strftime('%A')]
-
-    doctor_availability = db.query(models.DoctorAvailability).filter(models.DoctorAvailability.doctor_id == doctor_id,
-                                                                     models.DoctorAvailability.day_of_week == day_num).first()
-
-    doctor_start_time = doctor_availability.start_time
-
-    doctor_end_time = doctor_availability.end_time
-
-    doctor_break_start = doctor_availability.break_start
-
-    doctor_break_end = doctor_availability.break_end
-
-    doctor_appointment_duration = doctor_availability.appointment_duration
-
-    available_slots = []
-
-    current_time = datetime.combine(date,doctor_start_time)
-
-    doctor_end_time = datetime.combine(date,doctor_end_time)
-
-    while current_time < doctor_end_time:
-        slot_time = current_time.time()
-
-        in_booked = slot_time in un_available_slots
-        in_held   = slot_time in held_times
-        in_break  = doctor_break_start and doctor_break_end and (doctor_break_start <= slot_time < doctor_break_end)
-
-        if not (in_booked or in_held or in_break):
-                    available_slots.append(slot_time)
-
-        current_time = current_time + timedelta(minutes=doctor_appointment_duration)
-
-    return available_slots
-
-
-def make_slot_key(doctor_id : int, slot_time : datetime):
-    normalized_dt = slot_time.replace(microsecond=0, tzinfo=None)
-    raw =  f'slot_hold:doctor:{doctor_id}:{normalized_dt.isoformat()}'
-    return raw
-
-
+def bulk_set_availability(request : schemas.BulkAvailabilityRequest, db : session):
+    """Replace the weekly schedule of every doctor in the request; returns the changed (doctor_id, day_of_week) pairs."""
+    schedules = {}
+    for schedule in request.schedules:
+        week = schedules.setdefault(schedule.doctor_id, {})
+        for item in schedule.availabilities:
+            week[item.day_of_week] = availability_values(item)
+    return apply_availability_diff(db, schedules)
+
+
+def get_calendar_durations(db : session, doctor_id : int):
+    """Appointment duration per weekday (Sunday=0) of a doctor."""
+    durations = {}
+    for day_of_week, duration in db.query(
+        models.DoctorAvailability.day_of_week, models.DoctorAvailability.appointment_duration
+    ).filter(
+        models.DoctorAvailability.doctor_id == doctor_id,
+        models.DoctorAvailability.is_active == True
+    ):
+        durations.setdefault(day_of_week, duration)
+    return durations
+
+def get_calendar_version(db : session, doctor_id : int, start : datetime, end : datetime):
+    """
+    (count, last updated_at, max id, id sums of accepted and rejected ones) of a
+    doctor's appointments in [start, end), one aggregate query. The id sums catch
+    status changes within the same second, which updated_at can't tell apart on SQLite.
+    """
+    return db.query(
+        func.count(models.Appointments.id),
+        func.max(models.Appointments.updated_at),
+        func.max(models.Appointments.id),
+        func.sum(case((models.Appointments.status == models.Status.ACCECPTED, models.Appointments.id), else_=0)),
+        func.sum(case((models.Appointments.status == models.Status.REJECTED, models.Appointments.id), else_=0))
+    ).filter(
+        models.Appointments.doctor_id == doctor_id,
+        models.Appointments.date_time >= start,
+        models.Appointments.date_time < end
+    ).one()
+
+def get_doctor_calendar(db : session, doctor_id : int, start : datetime, end : datetime, durations : dict):
+    """Calendar events of a doctor in [start, end) with patient names, in one joined query."""
+    rows = db.query(
+        models.Appointments.id, models.Appointments.date_time, models.Appointments.status, models.User.name
+    ).join(
+        models.User, models.User.id == models.Appointments.patient_id
+    ).filter(
+        models.Appointments.doctor_id == doctor_id,
+        models.Appointments.date_time >= start,
+        models.Appointments.date_time < end
+    ).order_by(models.Appointments.date_time)
+
+    events = []
+    for appointment_id, date_time, status, patient_name in rows:
+        duration = durations.get(slot_index.day_of_week_number(date_time), 30)  # fallback default duration
+        events.append({
+            "id": appointment_id,
+            "title": patient_name,
+            "start": date_time.isoformat(),
+            "end": (date_time + timedelta(minutes=duration)).isoformat(),
+            "status": status.value
+        })
+    return events
+
+async def get_doctor_free_slots(doctor_id : int, date : datetime, db : AsyncSession):
+    return await slot_index.get_free_slots(main.redis_client, doctor_id, date, db)
+
+async def update_slot(doctor_id : int, slot_time : datetime, state : str, only_from : str = ""):
+    """
+    Record a slot state change in the slot index and drop cached free-slot lists
+    for that day. Returns slot_index.mark_slot's result (0: not in only_from).
+    """
+    changed = await slot_index.mark_slot(main.redis_client, doctor_id, slot_time, state, only_from)
+    await slot_cache.invalidate(main.redis_client, doctor_id, slot_time.replace(tzinfo=None).date())
+    return changed
+
+async def invalidate_doctor_slots(doctor_id : int, days_of_week = None):
+    await slot_index.invalidate_doctor(main.redis_client, doctor_id, days_of_week)
+    await slot_cache.invalidate(main.redis_client, doctor_id)
+
+async def invalidate_principal(user_id : int):
+    """Call after deleting a user or changing their role, name or email."""
+    await principal_cache.invalidate(main.redis_client, user_id)
+    # refresh tokens would keep minting access tokens with the old claims
+    await refresh_tokens.revoke_user(main.redis_client, user_id)
+    # and claims-only routes would keep accepting the access tokens out there
+    await token_cache.revoke_user(main.redis_client, user_id, auth.ACCESS_TOKEN_EXPIRE_TIME * 60)
+
+async def availability_changed(changes):
+    """Drop cached slots for the (doctor_id, day_of_week) pairs returned by apply_availability_diff."""
+    days_by_doctor = defaultdict(set)
+    for doctor_id, day_of_week in changes:
+        days_by_doctor[doctor_id].add(day_of_week)
+    for doctor_id, days_of_week in days_by_doctor.items():
+        await invalidate_doctor_slots(doctor_id, days_of_week)
+
+async def mark_slot_booked(doctor_id : int, slot_time : datetime):
+    await update_slot(doctor_id, slot_time, slot_index.BOOKED)
+
+async def mark_slot_released(doctor_id : int, slot_time : datetime):
+    # only a booked slot goes back to free; a hold placed since then is kept
+    await update_slot(doctor_id, slot_time, slot_index.FREE, only_from=slot_index.BOOKED)
+
+
+async def search_free_slots(db : AsyncSession, start_date, end_date, doctor_ids = None, limit : int = 10):
+    """
+    Earliest free slots across doctors and days, in time order.
+    Availability and appointments for the whole range are loaded in one query each,
+    holds in one Redis pipeline; days are only expanded as the merge consumes them.
+    """
+    availability_query = select(models.DoctorAvailability, models.User.name).join(
+        models.User, models.User.id == models.DoctorAvailability.doctor_id
+    )
+    if doctor_ids:
+        availability_query = availability_query.where(models.DoctorAvailability.doctor_id.in_(doctor_ids))
+
+    schedules = {}
+    doctor_names = {}
+    for availability, doctor_name in (await db.execute(availability_query)).all():
+        schedules.setdefault((availability.doctor_id, availability.day_of_week), availability)
+        doctor_names[availability.doctor_id] = doctor_name
+    if not schedules:
+        return []
+
+    range_start = datetime.combine(start_date, time.min)
+    range_end = datetime.combine(end_date + timedelta(days=1), time.min)
+    booked = defaultdict(list)
+    for doctor_id, date_time in (await db.execute(select(models.Appointments.doctor_id, models.Appointments.date_time).where(
+        models.Appointments.doctor_id.in_(doctor_names.keys()),
+        models.Appointments.date_time >= range_start,
+        models.Appointments.date_time < range_end,
+        models.Appointments.status.in_(['ACCECPTED', 'PENDING'])
+    ))).all():
+        booked[(doctor_id, date_time.date())].append(date_time.time())
+
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    held = await slot_holds.get_held_times_many(main.redis_client, doctor_names.keys(), days)
+    now = datetime.now()
+
+    def doctor_slots(doctor_id):
+        for day in days:
+            availability = schedules.get((doctor_id, slot_index.day_of_week_number(day)))
+            if availability is None:
+                continue
+            states = slot_index.build_day_states(day, availability, booked[(doctor_id, day)], held[(doctor_id, day)])
+            for slot_time in slot_index.free_slots_from_index(states):
+                slot_dt = datetime.combine(day, slot_time)
+                if slot_dt > now:
+                    yield slot_dt, doctor_id
+
+    merged = heapq.merge(*(doctor_slots(doctor_id) for doctor_id in doctor_names))
+    return [
+        {"doctor_id": doctor_id, "doctor_name": doctor_names[doctor_id], "slot_time": slot_dt.isoformat()}
+        for slot_dt, doctor_id in itertools.islice(merged, limit)
+    ]
@@ -19,36 +19,168 @@
 #         db.close()
 
 import os
+import itertools
+import logging
+import threading
+import time as t
 from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+import pool_metrics
+import query_budget
+import sqlite_tuning
 
 # Get database URL from environment variables
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test")
+# Comma separated read replicas of DATABASE_URL, used by get_read_db (read_routing.py)
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_EJECT_SECONDS = int(os.getenv("REPLICA_EJECT_SECONDS", 30))
 
-def create_database_engine(database_url):
+# Connections all workers together may hold on one database server. Each
+# worker's sync and async engines get an equal share of it.
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", 60))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))  # worker processes, same variable uvicorn reads
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))  # seconds to wait for a free connection
+ENGINES_PER_WORKER = 2
+
+def pool_limits():
+    """(pool_size, max_overflow) of one engine: a third of its share stays open, the rest is overflow."""
+    share = max(DB_CONNECTION_BUDGET // (WEB_CONCURRENCY * ENGINES_PER_WORKER), 1)
+    pool_size = max(share // 3, 1)
+    return pool_size, share - pool_size
+
+def create_database_engine(database_url, name="primary"):
     if database_url.startswith("postgresql"):
         # PostgreSQL configuration
-        return create_engine(
+        pool_size, max_overflow = pool_limits()
+        engine = create_engine(
             database_url,
+            poolclass=pool_metrics.TimedQueuePool,
             pool_pre_ping=True,      # Verify connections before use
             pool_recycle=3600,       # Recycle connections every hour
-            pool_size=10,            # Connection pool size
-            max_overflow=20,         # Max connections beyond pool_size
+            pool_size=pool_size,     # Connection pool size
+            max_overflow=max_overflow,  # Max connections beyond pool_size
+            pool_timeout=DB_POOL_TIMEOUT,
             echo=False               # Set to True for SQL debugging
         )
     else:
         # SQLite configuration (fallback for local development)
-        return create_engine(
+        engine = create_engine(
             database_url, 
+            poolclass=pool_metrics.TimedQueuePool,
             connect_args={"check_same_thread": False},
             echo=False
         )
+    pool_metrics.instrument(engine, name)
+    query_budget.instrument(engine)
+    return engine
+
+def create_async_database_engine(database_url, name="primary-async"):
+    """Async engine on the same database: asyncpg for PostgreSQL, aiosqlite for SQLite."""
+    url = make_url(database_url)
+    if url.drivername.startswith("postgresql"):
+        connect_args = {}
+        # asyncpg does not understand libpq's sslmode, it takes ssl instead
+        sslmode = url.query.get("sslmode")
+        if sslmode:
+            connect_args["ssl"] = sslmode
+            url = url.difference_update_query(["sslmode"])
+        pool_size, max_overflow = pool_limits()
+        engine = create_async_engine(
+            url.set(drivername="postgresql+asyncpg"),
+            poolclass=pool_metrics.TimedAsyncAdaptedQueuePool,
+            connect_args=connect_args,
+            pool_pre_ping=True,
+            pool_recycle=3600,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=DB_POOL_TIMEOUT,
+            echo=False
+        )
+    else:
+        engine = create_async_engine(
+            url.set(drivername="sqlite+aiosqlite"),
+            poolclass=pool_metrics.TimedAsyncAdaptedQueuePool,
+            echo=False
+        )
+    pool_metrics.instrument(engine.sync_engine, name)
+    query_budget.instrument(engine.sync_engine)
+    return engine
 
 engine = create_database_engine(DATABASE_URL)
+is_sqlite = make_url(DATABASE_URL).get_backend_name() == "sqlite"
+if is_sqlite:
+    sqlite_tuning.enforce_foreign_keys(engine)
+# SQLite in WAL mode (opt-in): reads get their own read-only engine, writes are queued (sqlite_tuning.py)
+sqlite_wal = sqlite_tuning.SQLITE_WAL and sqlite_tuning.is_sqlite_file(make_url(DATABASE_URL))
+if sqlite_wal:
+    sqlite_tuning.apply_pragmas(engine)
+    sqlite_tuning.serialize_writes(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_database_engine(DATABASE_URL)
+if is_sqlite:
+    sqlite_tuning.enforce_foreign_keys(async_engine.sync_engine)
+if sqlite_wal:
+    # aiosqlite writes wait on busy_timeout, the write queue is for the sync engine's threads
+    sqlite_tuning.apply_pragmas(async_engine.sync_engine)
+# expire_on_commit=False: attributes can't be lazy-loaded after a commit in async code
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+class ReplicaPool:
+    """
+    Round-robin over the replica engines. A replica that fails to hand out a
+    connection is ejected for REPLICA_EJECT_SECONDS and then tried again.
+    """
+    def __init__(self, engines, eject_seconds = REPLICA_EJECT_SECONDS):
+        self.engines = engines
+        self.eject_seconds = eject_seconds
+        self._ejected_until = {}
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.engines)
+
+    def candidates(self):
+        """Healthy replicas, starting from the next one in round-robin order."""
+        if not self.engines:
+            return []
+        now = t.monotonic()
+        with self._lock:
+            start = next(self._next) % len(self.engines)
+        ordered = self.engines[start:] + self.engines[:start]
+        return [engine for engine in ordered if self._ejected_until.get(engine, 0) <= now]
+
+    def eject(self, engine):
+        logging.warning(f"Ejecting read replica {engine.url.render_as_string(hide_password=True)} for {self.eject_seconds}s")
+        self._ejected_until[engine] = t.monotonic() + self.eject_seconds
+
+replicas = ReplicaPool([create_database_engine(url, f"replica-{i}") for i, url in enumerate(DATABASE_REPLICA_URLS)])
+# Reads of the WAL-mode SQLite file, when there are no replicas. Not a replica:
+# it sees every commit at once, so there is no lag for sticky routing to cover.
+sqlite_reader = None
+if sqlite_wal and not replicas:
+    sqlite_reader = create_database_engine(DATABASE_URL, "sqlite-reader")
+    sqlite_tuning.enforce_foreign_keys(sqlite_reader)
+    sqlite_tuning.apply_pragmas(sqlite_reader, read_only=True)
+
+def open_read_session():
+    """A session on a healthy replica, or on the SQLite reader or the primary if there is none."""
+    for replica in replicas.candidates():
+        db = SessionLocal(bind=replica)
+        try:
+            # check out the connection now, so a dead replica is skipped instead of failing the request
+            db.connection()
+            return db
+        except OperationalError:
+            db.close()
+            replicas.eject(replica)
+    return SessionLocal(bind=sqlite_reader) if sqlite_reader is not None else SessionLocal()
+
 # Database dependency
 def get_db():
     db = SessionLocal()
@@ -56,3 +188,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Async database dependency, for async def routes and WebSockets
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
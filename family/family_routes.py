@@ -1,9 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import select
+from typing import Optional
 from typing import List
 
 import models, schemas, auth, crud
 from database import engine, Base, get_db
+from read_routing import get_read_db
+from query_budget import max_queries
+import streaming
+from streaming import stream_format
 from family.crud import send_invitation, respond_invitation
 
 router = APIRouter(prefix="/family", tags=["Family"])
@@ -11,25 +17,25 @@ Base.metadata.create_all(engine)
 
 
 @router.get("/permissions/my")
+@max_queries(3)
 def get_my_family_permissions(
     current_user=Depends(auth.get_current_user), db: Session = Depends(get_db)
 ):
     conns = (
         db.query(models.FamilyConnections)
+        .options(joinedload(models.FamilyConnections.patient))
         .filter(models.FamilyConnections.family_member_id == current_user.id)
         .all()
     )
+    perms_by_patient = {
+        p.patient_id: p.permissions
+        for p in db.query(models.FamilyPermissions).filter(
+            models.FamilyPermissions.family_member_id == current_user.id
+        )
+    }
     out = []
     for c in conns:
-        perms = (
-            db.query(models.FamilyPermissions)
-            .filter(
-                models.FamilyPermissions.patient_id == c.patient_id,
-                models.FamilyPermissions.family_member_id == current_user.id,
-            )
-            .first()
-        )
-        plist = perms.permissions if perms else []
+        plist = perms_by_patient.get(c.patient_id) or []
         out.append(
             {
                 "patient_id": c.patient_id,
@@ -128,30 +134,49 @@ def delete_invitation(invitation_id: int, db: Session = Depends(get_db)):
 
 
 @router.get("/get_all_family_members")
-def get_all_family_members(current_user=Depends(auth.get_current_user)):
+@max_queries(2)
+def get_all_family_members(
+    current_user=Depends(auth.get_current_user), db: Session = Depends(get_db)
+):
+    conns = (
+        db.query(models.FamilyConnections)
+        .options(joinedload(models.FamilyConnections.family_member))
+        .filter(models.FamilyConnections.patient_id == current_user.id)
+        .all()
+    )
     return [
         {
             "id": conn.family_member.id,
             "name": conn.family_member.name,
             "relationship_type": conn.relationship_type,
         }
-        for conn in current_user.family_connections
+        for conn in conns
     ]
 
 
 @router.get("/get_related_family_members")
-def get_related_family_members(current_user=Depends(auth.get_current_user)):
+@max_queries(2)
+def get_related_family_members(
+    current_user=Depends(auth.get_current_user), db: Session = Depends(get_db)
+):
+    conns = (
+        db.query(models.FamilyConnections)
+        .options(joinedload(models.FamilyConnections.family_member))
+        .filter(models.FamilyConnections.family_member_id == current_user.id)
+        .all()
+    )
     return [
         {
             "id": conn.family_member.id,
             "name": conn.family_member.name,
             "relationship_type": conn.relationship_type,
         }
-        for conn in current_user.related_as_family
+        for conn in conns
     ]
 
 
 @router.get("/permissions/{patient_id}")
+@max_queries(4)
 def get_family_permissions(
     patient_id: int,
     current_user=Depends(auth.get_current_user),
@@ -170,22 +195,20 @@ def get_family_permissions(
     if not (is_patient or is_family_member):
         raise HTTPException(403, detail="Access denied")
 
+    perms_by_member = {
+        p.family_member_id: p.permissions
+        for p in db.query(models.FamilyPermissions).filter(
+            models.FamilyPermissions.patient_id == patient_id
+        )
+    }
     result = []
     for conn in (
         db.query(models.FamilyConnections)
+        .options(joinedload(models.FamilyConnections.family_member))
         .filter(models.FamilyConnections.patient_id == patient_id)
         .all()
     ):
-        perms = (
-            db.query(models.FamilyPermissions)
-            .filter(
-                models.FamilyPermissions.patient_id == patient_id,
-                models.FamilyPermissions.family_member_id
-                == conn.family_member_id,
-            )
-            .first()
-        )
-        plist = perms.permissions if perms else []
+        plist = perms_by_member.get(conn.family_member_id) or []
         result.append(
             {
                 "family_member_id": conn.family_member_id,
@@ -335,26 +358,31 @@ def check_family_permissions(
 
 
 @router.get('/my-patients')
+@max_queries(3)
 def get_my_patients(
     current_user = Depends(auth.check_family),
     db: Session = Depends(get_db)
 ):
     """Get all patients that this family member has access to"""
     
-    family_connections = db.query(models.FamilyConnections).filter(
+    family_connections = db.query(models.FamilyConnections).options(
+        joinedload(models.FamilyConnections.patient)
+    ).filter(
         models.FamilyConnections.family_member_id == current_user.id
     ).all()
     
+    # this family member's permissions, per patient
+    permissions = {
+        p.patient_id: p.permissions
+        for p in db.query(models.FamilyPermissions).filter(
+            models.FamilyPermissions.family_member_id == current_user.id
+        )
+    }
+    
     result = []
     for connection in family_connections:
         patient = connection.patient
-        
-        # Get permissions
-        permissions = db.query(models.FamilyPermissions).filter(
-            models.FamilyPermissions.family_member_id == current_user.id
-        ).first()
-        
-        permission_list = permissions.permissions if permissions else []
+        permission_list = permissions.get(patient.id) or []
         
         result.append({
             "patient_id": patient.id,
@@ -376,6 +404,7 @@ def get_my_patients(
 def family_book_appointment(
     patient_id: int,
     appointment: schemas.BookAppointment,
+    background_tasks: BackgroundTasks,
     current_user = Depends(auth.check_family),
     db: Session = Depends(get_db)
 ):
@@ -403,7 +432,11 @@ def family_book_appointment(
         raise HTTPException(status_code=403, detail="No permission to book appointments")
     
     # Book appointment for the patient
-    return crud.book_appointment(db, appointment, patient_id)
+    booking = crud.book_appointment(db, appointment, patient_id)
+    if not booking:
+        raise HTTPException(status_code=409, detail="Slot already booked")
+    background_tasks.add_task(crud.mark_slot_booked, booking.doctor_id, booking.date_time)
+    return booking
 
 @router.get('/patient-appointments/{patient_id}')
 def get_patient_appointments_for_family(
@@ -461,7 +494,7 @@ def get_patient_appointments_for_family(
 def get_patient_vitals_for_family(
     patient_id: int,
     current_user = Depends(auth.check_family),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get patient vitals if family member has view_records permission"""
     
@@ -498,7 +531,8 @@ def get_patient_vitals_for_family(
 def get_patient_records_for_family(
     patient_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.check_family)
+    current_user: models.User = Depends(auth.check_family),
+    fmt: Optional[str] = Depends(stream_format)
 ):
     """
     Family members can fetch vitals for a patient if they have view_records permission.
@@ -519,6 +553,11 @@ def get_patient_records_for_family(
         raise HTTPException(status_code=403, detail="No permission to view records")
 
     # Fetch vitals
+    if fmt:
+        statement = select(models.Vitals).where(
+            models.Vitals.patient_id == patient_id
+        ).order_by(models.Vitals.timestamp.desc())
+        return streaming.stream_query(db, statement, fmt, filename=f"patient_{patient_id}_vitals")
     vitals = db.query(models.Vitals).filter(
         models.Vitals.patient_id == patient_id
     ).order_by(models.Vitals.timestamp.desc()).all()
@@ -0,0 +1,133 @@
+"""
+WebSocket fan-out shared by the slot notifications and chat.
+
+Every connection gets a bounded outbound queue drained by its own writer task,
+so publishing never awaits a socket: one slow or half-dead client only fills
+its own queue. When a queue is full the overflow policy either drops the oldest
+queued message or disconnects the slow consumer. A connection whose send fails
+is closed and evicted from its topic automatically.
+"""
+import asyncio
+from collections import defaultdict
+from typing import Dict, Hashable, Iterable, Union
+from fastapi import WebSocket
+import enum
+import logging
+import os
+
+class OverflowPolicy(str, enum.Enum):
+    DROP_OLDEST = "drop_oldest"
+    DISCONNECT = "disconnect"
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 100))
+WS_OVERFLOW_POLICY = OverflowPolicy(os.getenv("WS_OVERFLOW_POLICY", OverflowPolicy.DROP_OLDEST.value))
+
+class OutboundConnection:
+    def __init__(self, websocket: WebSocket, max_queue: int, policy: OverflowPolicy, on_close, paused: bool = False):
+        self.websocket = websocket
+        self.policy = policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.closed = False
+        self._on_close = on_close
+        self._ready = asyncio.Event()
+        if not paused:
+            self._ready.set()
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def resume(self):
+        """Start sending what a paused connection has queued so far."""
+        self._ready.set()
+
+    def send(self, message: Union[str, dict]) -> bool:
+        """Queue a message without waiting; returns False if the connection is (now) closed."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            if self.policy == OverflowPolicy.DISCONNECT:
+                logging.warning("Disconnecting slow WebSocket consumer")
+                self.close(code=1013)
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(message)
+            self.dropped += 1
+        return True
+
+    async def _write_loop(self):
+        try:
+            await self._ready.wait()
+            while True:
+                message = await self.queue.get()
+                if isinstance(message, str):
+                    await self.websocket.send_text(message)
+                else:
+                    await self.websocket.send_json(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.info(f"Evicting WebSocket after failed send: {e}")
+            self.close()
+
+    def close(self, code: int = 1000, close_socket: bool = True):
+        if self.closed:
+            return
+        self.closed = True
+        self._on_close(self)
+        if asyncio.current_task() is not self._writer:
+            self._writer.cancel()
+        if close_socket:
+            asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+class FanoutHub:
+    def __init__(self, max_queue: int = WS_SEND_QUEUE_SIZE, policy: OverflowPolicy = WS_OVERFLOW_POLICY):
+        self.max_queue = max_queue
+        self.policy = policy
+        self.topics: Dict[Hashable, Dict[WebSocket, OutboundConnection]] = defaultdict(dict)
+
+    def subscribe(self, topic: Hashable, websocket: WebSocket, paused: bool = False) -> OutboundConnection:
+        """
+        paused: queue messages but hold them until connection.resume(), so the caller
+        can send something (e.g. an initial snapshot) directly before any of them.
+        """
+        connection = OutboundConnection(
+            websocket, self.max_queue, self.policy,
+            on_close=lambda conn: self._evict(topic, conn),
+            paused=paused
+        )
+        self.topics[topic][websocket] = connection
+        return connection
+
+    def unsubscribe(self, topic: Hashable, websocket: WebSocket):
+        connection = self.topics.get(topic, {}).get(websocket)
+        if connection is not None:
+            # the client is already gone, only stop the writer
+            connection.close(close_socket=False)
+
+    def _evict(self, topic: Hashable, connection: OutboundConnection):
+        connections = self.topics.get(topic)
+        if connections is not None and connections.get(connection.websocket) is connection:
+            del connections[connection.websocket]
+            if not connections:
+                del self.topics[topic]
+
+    def subscribers(self, topics: Iterable[Hashable]) -> Dict[WebSocket, OutboundConnection]:
+        found = {}
+        for topic in topics:
+            found.update(self.topics.get(topic, {}))
+        return found
+
+    def publish(self, topics: Iterable[Hashable], message: Union[str, dict]) -> int:
+        """Queue message for every socket subscribed to any of the topics (once per socket)."""
+        delivered = 0
+        for connection in list(self.subscribers(topics).values()):
+            if connection.send(message):
+                delivered += 1
+        return delivered
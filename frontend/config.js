@@ -33,3 +33,59 @@ const API_CONFIG = {
 };
 
 window.API_CONFIG = API_CONFIG;
+
+// Access tokens are short-lived. When an authorized request comes back 401,
+// trade the refresh token (saved at login) for a new pair once and retry the
+// request with the new access token. Concurrent 401s share one refresh: the
+// server revokes the session if the same refresh token is used twice.
+const nativeFetch = window.fetch.bind(window);
+let pendingRefresh = null;
+
+async function refreshAccessToken() {
+  const refreshToken = sessionStorage.getItem("refresh_token");
+  if (!refreshToken) return null;
+  const response = await nativeFetch(`${API_CONFIG.getApiBaseUrl()}/token/refresh`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ refresh_token: refreshToken })
+  });
+  if (!response.ok) {
+    sessionStorage.removeItem("refresh_token");
+    return null;
+  }
+  const data = await response.json();
+  sessionStorage.setItem("token", data.access_token);
+  sessionStorage.setItem("refresh_token", data.refresh_token);
+  return data.access_token;
+}
+
+window.fetch = async (input, init = {}) => {
+  const response = await nativeFetch(input, init);
+  const headers = new Headers(init.headers || {});
+  const sent = headers.get("Authorization");
+  if (response.status !== 401 || !sent || !sent.startsWith("Bearer ")) return response;
+
+  let token = sessionStorage.getItem("token");
+  if (!token || `Bearer ${token}` === sent) {
+    // the stored token is the one that failed; pages holding an older copy skip straight to the retry
+    pendingRefresh = pendingRefresh || refreshAccessToken().finally(() => { pendingRefresh = null; });
+    token = await pendingRefresh;
+  }
+  if (!token) return response;
+  headers.set("Authorization", `Bearer ${token}`);
+  return nativeFetch(input, { ...init, headers });
+};
+
+// Server side of logging out: revoke the access token and the refresh token
+// of this session. keepalive lets it finish while the page navigates away.
+API_CONFIG.revokeSession = () => {
+  const token = sessionStorage.getItem("token");
+  if (!token) return;
+  const refreshToken = sessionStorage.getItem("refresh_token");
+  nativeFetch(`${API_CONFIG.getApiBaseUrl()}/logout`, {
+    method: "POST",
+    keepalive: true,
+    headers: { "Authorization": `Bearer ${token}`, "Content-Type": "application/json" },
+    body: refreshToken ? JSON.stringify({ refresh_token: refreshToken }) : undefined
+  }).catch(() => {});
+};
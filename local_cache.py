@@ -0,0 +1,65 @@
+"""
+Building blocks of the per-worker caches (slot_cache.py, principal_cache.py).
+
+GenerationalLRU is an LRU of entries that expire after a TTL. Keys belong to
+a group (e.g. every day of one doctor) with a generation that is bumped on
+every invalidation of the group, so a value loaded before an invalidation
+and stored after it is dropped instead of serving stale data.
+
+Invalidations are published as JSON on a Redis channel and applied by every
+worker's listen() task.
+"""
+from collections import OrderedDict
+import json
+import logging
+import time as t
+
+class GenerationalLRU:
+    def __init__(self, ttl : float, max_entries : int, group_of = lambda key: key):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.group_of = group_of
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._generations = {}         # group -> bumped on every invalidation
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= t.monotonic():
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def generation(self, key):
+        """Pass to put() along with a value loaded after this call."""
+        return self._generations.get(self.group_of(key), 0)
+
+    def put(self, key, value, generation : int):
+        # loaded before the last invalidation, don't keep it
+        if self.generation(key) != generation:
+            return
+        self._entries[key] = (t.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, group, key = None):
+        """Bump group's generation and drop key, or every key of the group when key is None."""
+        self._generations[group] = self._generations.get(group, 0) + 1
+        keys = [key] if key is not None else [k for k in self._entries if self.group_of(k) == group]
+        for k in keys:
+            self._entries.pop(k, None)
+
+async def publish(redis_client, channel : str, message : dict):
+    await redis_client.publish(channel, json.dumps(message))
+
+async def listen(redis_client, channel : str, apply):
+    """Call apply(message) for every JSON message on channel; malformed ones are logged and skipped."""
+    pubsub = redis_client.pubsub()
+    await pubsub.subscribe(channel)
+    async for message in pubsub.listen():
+        if message['type'] != 'message':
+            continue
+        try:
+            apply(json.loads(message['data']))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Ignoring malformed message on {channel}: {e}")
@@ -3,12 +3,16 @@ load_dotenv()
 
 from fastapi.staticfiles import StaticFiles
 import schemas, utils, models
-from sqlalchemy.orm import session
-from database import Base, SessionLocal, engine
-from fastapi import APIRouter, FastAPI, HTTPException, Depends, Request, Query
-from fastapi.responses import JSONResponse, RedirectResponse
+from sqlalchemy.orm import session, joinedload
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select
+from database import Base, SessionLocal, AsyncSessionLocal, engine, async_engine, get_async_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, FastAPI, HTTPException, Depends, Request, Query, BackgroundTasks
+from fastapi.responses import JSONResponse, RedirectResponse, Response
+from fastapi.concurrency import run_in_threadpool
 import crud
-from typing import List
+from typing import List, Optional
 from fastapi.security import OAuth2PasswordRequestForm
 import auth
 from family.family_routes import router as family_routes
@@ -17,12 +21,27 @@ from chat.chat_auth import router as chat_auth
 from admin.admin_routes import router as admin_router
 from realtime import router as realtime_router
 import realtime
+import slot_index
+import slot_holds
+import slot_cache
+import principal_cache
+import refresh_tokens
+import token_cache
+from read_routing import get_read_db
+import read_routing
+import query_budget
+import streaming
+from streaming import stream_format
+from query_budget import max_queries
 from datetime import timedelta
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 import colorlog
 import traceback
-from datetime import datetime, date, time
+from datetime import datetime, date, time, timezone
+from email.utils import format_datetime
+import hashlib
+import importlib.util
 import time as t
 import redis.asyncio as redis
 import asyncio
@@ -32,32 +51,51 @@ import socket
 from starlette.middleware.base import BaseHTTPMiddleware
 import uvicorn
 
-async def listen_for_expired_keys():
-    pubsub = redis_client.pubsub()
-    await pubsub.subscribe("__keyevent@0__:expired")
-    async for message in pubsub.listen():
-        if message['type'] == 'message':
-            expired_key = message['data'].decode()
-            # Parse expired_key to extract doctor_id, slot_time
-            if expired_key.startswith("slot_hold:doctor:"):
-                parts = expired_key.split(":")
-                doctor_id = int(parts[2])
-                slot_time = datetime.fromisoformat(parts[3])
-                await realtime.notify_slot_update(doctor_id, slot_time, "freed")
+HOLD_SWEEP_INTERVAL = 1  # seconds
+
+async def free_expired_holds():
+    """
+    Free the slots whose hold expired. Every worker sweeps, but each expired
+    hold is claimed by exactly one of them, so at most one "freed" event goes
+    out; none if the slot was no longer held (e.g. booked just before expiry).
+    """
+    for doctor_id, slot_time in await slot_holds.claim_expired_holds(redis_client):
+        # 0: the index shows another state than held; -1: day not indexed, assume freed
+        if await crud.update_slot(doctor_id, slot_time, slot_index.FREE, only_from=slot_index.HELD) != 0:
+            await realtime.publish_slot_update(redis_client, doctor_id, slot_time, "freed")
+
+async def sweep_expired_holds():
+    while True:
+        try:
+            await free_expired_holds()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Expired hold sweep failed: {e}")
+        await asyncio.sleep(HOLD_SWEEP_INTERVAL)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Start your background task
-    task = asyncio.create_task(listen_for_expired_keys())
+    tasks = [
+        asyncio.create_task(sweep_expired_holds()),
+        asyncio.create_task(realtime.listen_for_slot_updates(redis_client)),
+        asyncio.create_task(slot_cache.listen_for_invalidations(redis_client)),
+        asyncio.create_task(principal_cache.listen_for_invalidations(redis_client)),
+    ]
     try:
         yield
     finally:
-        # Cancel background task gracefully on shutdown
-        task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
+        # Cancel background tasks gracefully on shutdown
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await async_engine.dispose()
+        utils.password_pool.shutdown()
 
 HOLD_TTL = 5 * 60  # 5 minutes in seconds
 
@@ -236,6 +274,21 @@ class RequestLoggingMiddleware(BaseHTTPMiddleware):
 # Add the middleware to your app
 app.add_middleware(RequestLoggingMiddleware)
 
+@app.middleware("http")
+async def read_your_writes(request: Request, call_next):
+    # users who just wrote are kept off the read replicas for a moment (read_routing.py)
+    response = await call_next(request)
+    await read_routing.record_write(redis_client, request, response)
+    return response
+
+@app.middleware("http")
+async def count_queries(request: Request, call_next):
+    # statements and DB time of the request, N+1 and budget warnings (query_budget.py)
+    with query_budget.track() as queries:
+        response = await call_next(request)
+    query_budget.report(request, response, queries)
+    return response
+
 # Include routers
 app.include_router(family_routes)
 app.include_router(chat_router)
@@ -263,88 +316,141 @@ async def root(request: Request):
         return RedirectResponse(url="/frontend/")
 
 @app.post('/register_patient', response_model=schemas.UsersOut)
-def create_patient(patient : schemas.InsertPatient, db : session = Depends(get_db)):
-    if crud.check_user_by_email(db, patient.email):
+async def create_patient(patient : schemas.InsertPatient, db : session = Depends(get_db)):
+    if await run_in_threadpool(crud.check_user_by_email, db, patient.email):
         raise HTTPException(status_code=400, detail='patient already exists')
     
-    patient.password = utils.hash_password(patient.password)
-    return crud.insert_patient(db, patient)
+    patient.password = await utils.hash_password_async(patient.password)
+    return await run_in_threadpool(crud.insert_patient, db, patient)
 
 @app.post('/register_doctor', response_model=schemas.UsersOut)
-def create_doctor(doctor : schemas.InsertDoctor, db : session = Depends(get_db)):
-    if crud.check_user_by_email(db, doctor.email):
+async def create_doctor(doctor : schemas.InsertDoctor, db : session = Depends(get_db)):
+    if await run_in_threadpool(crud.check_user_by_email, db, doctor.email):
         raise HTTPException(status_code=400, detail='doctor already exists')
 
-    doctor.password = utils.hash_password(doctor.password)
-    return crud.insert_doctor(db, doctor)
+    doctor.password = await utils.hash_password_async(doctor.password)
+    return await run_in_threadpool(crud.insert_doctor, db, doctor)
 
 @app.post('/register_family', response_model=schemas.UsersOut)
-def create_family(family : schemas.InsertFamily, db : session = Depends(get_db)):
-    if crud.check_user_by_email(db, family.email):
-        HTTPException(status_code=400, detail='family member already exists')
+async def create_family(family : schemas.InsertFamily, db : session = Depends(get_db)):
+    if await run_in_threadpool(crud.check_user_by_email, db, family.email):
+        raise HTTPException(status_code=400, detail='family member already exists')
 
-    family.password = utils.hash_password(family.password)
-    return crud.insert_family(db, family)
+    family.password = await utils.hash_password_async(family.password)
+    return await run_in_threadpool(crud.insert_family, db, family)
 
 @app.post('/token')  # This matches your tokenUrl
-def login_for_swagger(form_data: OAuth2PasswordRequestForm = Depends(), db: session = Depends(get_db)):
+async def login_for_swagger(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     # Use form_data.username as email (since users will enter email in username field)
-    user = db.query(models.User).filter(models.User.email == form_data.username).first()
+    user = (await db.scalars(select(models.User).where(models.User.email == form_data.username))).first()
     if not user:
         raise HTTPException(400, "Invalid email or password")
-    if not utils.verify_password(form_data.password, user.hashed_password):
+    if not await utils.verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(400, "Invalid email or password")
-    access_token = auth.create_access_token(
-        data={'sub' : user.email, 'id' : user.id, 'role' : user.role}
-    )
-    return {'access_token' : access_token, 'token_type' : 'bearer', 'role' : user.role, 'user_id' : user.id}
-
-@app.get('/user/me')
+    if utils.pwd_context.needs_update(user.hashed_password):
+        # hashed with an older BCRYPT_ROUNDS: upgrade while we have the password
+        user.hashed_password = await utils.hash_password_async(form_data.password)
+        await db.commit()
+    claims = {'sub' : user.email, 'id' : user.id, 'role' : user.role.value}
+    access_token = auth.create_access_token(data=claims)
+    refresh_token = await refresh_tokens.issue(redis_client, claims)
+    return {'access_token' : access_token, 'refresh_token' : refresh_token, 'token_type' : 'bearer', 'role' : user.role, 'user_id' : user.id}
+
+@app.post('/token/refresh')
+async def refresh_access_token(request : schemas.RefreshTokenRequest):
+    """New access token for a refresh token, no password check. The refresh token is rotated."""
+    try:
+        claims, refresh_token = await refresh_tokens.rotate(redis_client, request.refresh_token)
+    except refresh_tokens.RefreshTokenReused:
+        logging.warning("Refresh token reuse detected, session revoked")
+        raise HTTPException(401, "Session revoked, log in again")
+    except refresh_tokens.InvalidRefreshToken:
+        raise HTTPException(401, "Refresh token is invalid or expired")
+    access_token = auth.create_access_token(data=claims)
+    return {'access_token' : access_token, 'refresh_token' : refresh_token, 'token_type' : 'bearer', 'role' : claims['role'], 'user_id' : claims['id']}
+
+@app.post('/logout')
+async def logout(request : Optional[schemas.RefreshTokenRequest] = None, token : str = Depends(auth.oauth2_schema)):
+    """Revoke this access token and, if given, the session's refresh token."""
+    claims = await auth.verify_claims(token)
+    await token_cache.revoke_token(redis_client, claims)
+    if request is not None:
+        await refresh_tokens.revoke(redis_client, request.refresh_token, claims["id"])
+    return {"detail": "Logged out"}
+
+@app.get('/user/me', response_model=schemas.UsersOut)
+@max_queries(1)
 def read_users_me(current_user = Depends(auth.get_current_user)):
     return current_user
 
 @app.get('/all_doctors', response_model=List[schemas.UsersOut])
-def all_users(db : session = Depends(get_db)):
+@max_queries(1)
+def all_users(db : session = Depends(get_read_db)):
     return crud.get_all_doctors(db)
 
 @app.post('/create_appointment')
-def create_appointment(appointment : schemas.BookAppointment, db : session = Depends(get_db), current_user = Depends(auth.get_current_user)):
-    return crud.book_appointment(db, appointment, current_user.id)
-
-def get_appointment_end(start_dt: datetime, doctor_id: int, db: session):
-    day_of_week = start_dt.weekday()  # Monday=0
-    availability = db.query(models.DoctorAvailability).filter(
-        models.DoctorAvailability.doctor_id == doctor_id,
-        models.DoctorAvailability.day_of_week == day_of_week,
-        models.DoctorAvailability.is_active == True
-    ).first()
-
-    if availability:
-        duration_minutes = availability.appointment_duration
-    else:
-        duration_minutes = 30  # fallback default duration
+def create_appointment(appointment : schemas.BookAppointment, background_tasks: BackgroundTasks, db : session = Depends(get_db), current_user = Depends(auth.get_current_user)):
+    booking = crud.book_appointment(db, appointment, current_user.id)
+    if not booking:
+        raise HTTPException(status_code=409, detail='Slot already booked')
+    background_tasks.add_task(crud.mark_slot_booked, booking.doctor_id, booking.date_time)
+    return booking
 
-    end_dt = start_dt + timedelta(minutes=duration_minutes)
-    return end_dt
+CALENDAR_DEFAULT_PAST_DAYS = 31
+CALENDAR_MAX_DAYS = 400
 
 @app.get('/get_all_appointments')
-def get_all_appointments(doctor = Depends(auth.check_doctor), db: session = Depends(get_db)):
-    result = []
-    for app in doctor.doctor_appointments:
-        start = app.date_time
-        end = get_appointment_end(start, doctor.id, db)
-        result.append({
-            "id": app.id,
-            "title": app.patient.name,
-            "start": start.isoformat(),
-            "end": end.isoformat(),
-            "status": app.status.value
-        })
-    return result
+@max_queries(3)
+def get_all_appointments(
+    request: Request,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    doctor = Depends(auth.doctor_claims),
+    db: session = Depends(get_db)
+):
+    """
+    Calendar events of the doctor in [start, end). Defaults to the last month plus
+    the next ones up to CALENDAR_MAX_DAYS. Sends ETag/Last-Modified and answers 304
+    when the window is unchanged.
+    """
+    if start is None:
+        start = datetime.combine(date.today() - timedelta(days=CALENDAR_DEFAULT_PAST_DAYS), time.min)
+    if end is None:
+        end = start + timedelta(days=CALENDAR_MAX_DAYS)
+    # appointment times are stored as wall-clock times
+    start, end = start.replace(tzinfo=None), end.replace(tzinfo=None)
+    if end <= start or end - start > timedelta(days=CALENDAR_MAX_DAYS):
+        raise HTTPException(status_code=400, detail=f"Window must be positive and at most {CALENDAR_MAX_DAYS} days")
+
+    durations = crud.get_calendar_durations(db, doctor.id)
+    count, last_updated, max_id, accepted_ids, rejected_ids = crud.get_calendar_version(db, doctor.id, start, end)
+    version = (f"{doctor.id}|{start.isoformat()}|{end.isoformat()}|{count}|{last_updated}|{max_id}|"
+               f"{accepted_ids}|{rejected_ids}|{sorted(durations.items())}")
+    etag = '"' + hashlib.sha1(version.encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_updated is not None:
+        if last_updated.tzinfo is None:
+            last_updated = last_updated.replace(tzinfo=timezone.utc)
+        headers["Last-Modified"] = format_datetime(last_updated.astimezone(timezone.utc), usegmt=True)
+
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(crud.get_doctor_calendar(db, doctor.id, start, end, durations), headers=headers)
 
 @app.put('/appointment_response')
-def appointment_response(response : schemas.AppointmentResponse, db : session = Depends(get_db), doctor = Depends(auth.check_doctor)):
-    return crud.appointment_response(db, response)
+def appointment_response(response : schemas.AppointmentResponse, background_tasks: BackgroundTasks, db : session = Depends(get_db), doctor = Depends(auth.check_doctor)):
+    try:
+        appointment = crud.appointment_response(db, response)
+    except IntegrityError:
+        # accepting a rejected appointment whose slot has been booked again since
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Slot already booked")
+    # a rejected appointment can be accepted again, so both directions update the slot
+    if appointment.status == models.Status.REJECTED:
+        background_tasks.add_task(crud.mark_slot_released, appointment.doctor_id, appointment.date_time)
+    else:
+        background_tasks.add_task(crud.mark_slot_booked, appointment.doctor_id, appointment.date_time)
+    return appointment
 
 @app.post('/add_vital')
 def add_vital(
@@ -384,7 +490,14 @@ def add_vital(
     }
 
 @app.get('/get_vital')
-def get_vitals(patient = Depends(auth.check_patient), db: session = Depends(get_db)):
+@max_queries(1)
+def get_vitals(patient = Depends(auth.patient_claims), db: session = Depends(get_read_db),
+               fmt: Optional[str] = Depends(stream_format)):
+    if fmt:
+        statement = select(models.Vitals).where(
+            models.Vitals.patient_id == patient.id
+        ).order_by(models.Vitals.timestamp.desc())
+        return streaming.stream_query(db, statement, fmt, filename="vitals")
     vitals = db.query(models.Vitals).filter(
         models.Vitals.patient_id == patient.id
     ).order_by(models.Vitals.timestamp.desc()).all()
@@ -449,50 +562,33 @@ def ensure_time(val):
 @app.put('/doctor/availability')
 def update_doctor_availability(
     availability: schemas.AvailabilityItem,  # one availability object
+    background_tasks: BackgroundTasks,
     doctor = Depends(auth.check_doctor),
     db: session = Depends(get_db),
 ):
-    # Check if availability with same day_of_week exists
-    existing = db.query(models.DoctorAvailability).filter(
-        models.DoctorAvailability.doctor_id == doctor.id,
-        models.DoctorAvailability.day_of_week == availability.day_of_week,
-        models.DoctorAvailability.is_active == True
-    ).first()
-
     def parse_time(val):
         if isinstance(val, str):
             return datetime.strptime(val, "%H:%M").time()
         return val
 
-    if existing:
-        # Update existing record
-        existing.start_time = parse_time(availability.start_time)
-        existing.end_time = parse_time(availability.end_time)
-        existing.appointment_duration = availability.appointment_duration
-        existing.break_start = parse_time(availability.break_start) if availability.break_start else None
-        existing.break_end = parse_time(availability.break_end) if availability.break_end else None
-        db.add(existing)
-    else:
-        # Create new
-        new_avail = models.DoctorAvailability(
-            doctor_id=doctor.id,
-            day_of_week=availability.day_of_week,
-            start_time=parse_time(availability.start_time),
-            end_time=parse_time(availability.end_time),
-            appointment_duration=availability.appointment_duration,
-            break_start=parse_time(availability.break_start) if availability.break_start else None,
-            break_end=parse_time(availability.break_end) if availability.break_end else None,
-            is_active=True
-        )
-        db.add(new_avail)
-
-    db.commit()
+    values = {
+        "start_time": parse_time(availability.start_time),
+        "end_time": parse_time(availability.end_time),
+        "appointment_duration": availability.appointment_duration,
+        "break_start": parse_time(availability.break_start) if availability.break_start else None,
+        "break_end": parse_time(availability.break_end) if availability.break_end else None,
+    }
+    # only this weekday is written, the doctor's other days stay as they are
+    changes = crud.apply_availability_diff(db, {doctor.id: {availability.day_of_week: values}}, replace_week=False)
+    if changes:
+        background_tasks.add_task(crud.availability_changed, changes)
 
     return {"message": "Availability updated"}
 
 @app.delete('/doctor/availability/{avail_id}')
 def delete_doctor_availability(
     avail_id: int,
+    background_tasks: BackgroundTasks,
     doctor = Depends(auth.check_doctor),
     db: session = Depends(get_db)
 ):
@@ -506,6 +602,7 @@ def delete_doctor_availability(
     
     db.delete(availability)
     db.commit()
+    background_tasks.add_task(crud.invalidate_doctor_slots, doctor.id)
     return {"message": "Availability deleted successfully"}
 
 @app.get('/doctor/availability')
@@ -547,20 +644,53 @@ def get_doctor_availability(
 async def get_available_appointment(
     app_date : date,
     doctor_id : int,
-    db: session = Depends(get_db),
 ):
-    return await crud.get_doctor_free_slots(doctor_id, app_date, db)
+    async def compute():
+        # shared by every request waiting on this key, so it can't use one request's session
+        async with AsyncSessionLocal() as db:
+            return await crud.get_doctor_free_slots(doctor_id, app_date, db)
+    return await slot_cache.cache.get_or_compute(doctor_id, app_date, compute)
+
+@app.get('/available_appointment/month')
+async def get_available_appointment_month(
+    doctor_id : int,
+    year : int = Query(..., ge=2000, le=2100),
+    month : int = Query(..., ge=1, le=12),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Number of free slots for each day of the month, for the booking date picker"""
+    days = await slot_index.get_month_summary(redis_client, doctor_id, year, month, db)
+    return {"doctor_id": doctor_id, "year": year, "month": month, "days": days}
+
+MAX_SEARCH_DAYS = 31
+
+@app.get('/available_appointment/search')
+async def search_available_appointments(
+    start_date : date,
+    end_date : date,
+    doctor_ids : Optional[List[int]] = Query(None),
+    limit : int = Query(10, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Earliest free slots between start_date and end_date, across all (or the given) doctors"""
+    if end_date < start_date:
+        raise HTTPException(status_code=400, detail='end_date must not be before start_date')
+    if (end_date - start_date).days >= MAX_SEARCH_DAYS:
+        raise HTTPException(status_code=400, detail=f'Date range cannot exceed {MAX_SEARCH_DAYS} days')
+
+    return await crud.search_free_slots(db, start_date, end_date, doctor_ids, limit)
 
 @app.post('/reserve_slot')
 async def reserve_slot(appointment : schemas.BookAppointment, user_id: int):
     
-    slot_reserve_key = crud.make_slot_key(appointment.doctor_id, appointment.appointment_date)
-    success = await redis_client.set(slot_reserve_key, user_id, ex=HOLD_TTL, nx=True) #NX = "Not eXists" = Only set if key does not exist.
+    success = await slot_holds.reserve_hold(redis_client, appointment.doctor_id, appointment.appointment_date, user_id, HOLD_TTL)
 
     if not success:
         raise HTTPException(status_code=409, detail='Slot already reserved by another user')
 
-    await realtime.notify_slot_update(
+    await crud.update_slot(appointment.doctor_id, appointment.appointment_date, slot_index.HELD, only_from=slot_index.FREE)
+    await realtime.publish_slot_update(
+        redis_client,
         doctor_id=appointment.doctor_id,
         slot_time=appointment.appointment_date,
         action="reserved"
@@ -569,51 +699,52 @@ async def reserve_slot(appointment : schemas.BookAppointment, user_id: int):
     return {"message": "Slot reserved", "expires_in": HOLD_TTL}
 
 @app.post('/confirm_slot')
-async def confirm_slot(appointment : schemas.BookAppointment, user_id: int = Query(...), db : session = Depends(get_db)):
+async def confirm_slot(appointment : schemas.BookAppointment, user_id: int = Query(...), db : AsyncSession = Depends(get_async_db)):
     
-    slot_reserve_key = crud.make_slot_key(appointment.doctor_id, appointment.appointment_date)
-    holder = await redis_client.get(slot_reserve_key)
+    # the hold is only consumed once the insert has committed, so a failed insert
+    # leaves the patient holding the slot; two confirms racing past the check are
+    # settled by the unique index
+    held = await slot_holds.check_hold(redis_client, appointment.doctor_id, appointment.appointment_date, user_id)
 
-    if holder is None:
+    if held == -1:
         raise HTTPException(410, "Reservation expired or not found")
     
-    # Handle both bytes and string responses
-    try:
-        if isinstance(holder, bytes):
-            holder_value = int(holder.decode())
-        else:
-            holder_value = int(holder)
-    except (ValueError, AttributeError) as e:
-        raise HTTPException(500, f"Invalid reservation data: {e}")
-    
-    if holder_value != user_id:
+    if held == 0:
         raise HTTPException(403, "You do not hold this reservation")
     
-    booking = crud.book_appointment(db, appointment, user_id)
+    booking = await crud.async_book_appointment(db, appointment, user_id)
+    await slot_holds.consume_hold(redis_client, appointment.doctor_id, appointment.appointment_date, user_id)
 
-    if not booking:
-        raise HTTPException(status_code=409, detail='booking cannot be processed')
+    # booked or not, the slot now has an active appointment
+    await crud.update_slot(appointment.doctor_id, appointment.appointment_date, slot_index.BOOKED)
 
-    await redis_client.delete(slot_reserve_key)
+    if not booking:
+        raise HTTPException(status_code=409, detail='Slot already booked')
     
     return {"message": "Booking confirmed", "slot_time": appointment.appointment_date}
 
 @app.post("/cancel_slot")
 async def cancel_slot(doctor_id: int, slot_time: datetime, user_id: int):
-    key = crud.make_slot_key(doctor_id, slot_time)
-    holder = await redis_client.get(key)
-    if holder and int(holder) == user_id:
-        await redis_client.delete(key)
-        await realtime.notify_slot_update(doctor_id, slot_time, "freed")
+    # check the holder and drop the hold in one step: the hold may expire and be
+    # taken by another patient between a separate GET and DEL
+    if await slot_holds.consume_hold(redis_client, doctor_id, slot_time, user_id) == 1:
+        await crud.update_slot(doctor_id, slot_time, slot_index.FREE, only_from=slot_index.HELD)
+        await realtime.publish_slot_update(redis_client, doctor_id, slot_time, "freed")
         return {"message": "Reservation cancelled and slot freed"}
     raise HTTPException(404, "No active reservation found")
 
 @app.get('/patient/appointments')
 def get_patient_appointments(
-    current_user = Depends(auth.check_patient),  # Only patients can access
-    db: session = Depends(get_db)
+    current_user = Depends(auth.patient_claims),  # Only patients can access
+    db: session = Depends(get_db),
+    fmt: Optional[str] = Depends(stream_format)
 ):
     """Get appointments for the current patient"""
+    if fmt:
+        statement = select(models.Appointments).where(
+            models.Appointments.patient_id == current_user.id
+        ).order_by(models.Appointments.id)
+        return streaming.stream_query(db, statement, fmt, filename="appointments")
     appointments = db.query(models.Appointments).filter(
         models.Appointments.patient_id == current_user.id
     ).all()
@@ -629,18 +760,21 @@ async def redis_test():
         return {"status": "error", "message": str(e)}
 
 @app.get('/patient/appointments/detailed')
+@max_queries(1)
 def get_patient_appointments_detailed(
-    current_user = Depends(auth.check_patient),
+    current_user = Depends(auth.patient_claims),
     db: session = Depends(get_db)
 ):
     """Get detailed appointments for the current patient with doctor info"""
-    appointments = db.query(models.Appointments).filter(
+    appointments = db.query(models.Appointments).options(
+        joinedload(models.Appointments.doctor)
+    ).filter(
         models.Appointments.patient_id == current_user.id
     ).all()
     
     result = []
     for appointment in appointments:
-        doctor_info = db.query(models.User).filter(models.User.id == appointment.doctor_id).first()
+        doctor_info = appointment.doctor
         
         result.append({
             "id": appointment.id,
@@ -663,6 +797,7 @@ def get_patient_appointments_detailed(
 @app.put('/patient/appointments/{appointment_id}/cancel')
 def cancel_patient_appointment(
     appointment_id: int,
+    background_tasks: BackgroundTasks,
     current_user = Depends(auth.check_patient),
     db: session = Depends(get_db)
 ):
@@ -680,6 +815,7 @@ def cancel_patient_appointment(
     
     appointment.status = models.Status.REJECTED
     db.commit()
+    background_tasks.add_task(crud.mark_slot_released, appointment.doctor_id, appointment.date_time)
     
     return {
         "message": "Appointment cancelled successfully",
@@ -691,6 +827,7 @@ def cancel_patient_appointment(
 def reschedule_appointment(
     appointment_id: int,
     new_appointment: schemas.BookAppointment,
+    background_tasks: BackgroundTasks,
     current_user = Depends(auth.check_patient),
     db: session = Depends(get_db)
 ):
@@ -707,13 +844,20 @@ def reschedule_appointment(
     if existing_appointment.status.value != "pending":
         raise HTTPException(status_code=400, detail="Can only reschedule pending appointments")
     
+    background_tasks.add_task(crud.mark_slot_released, existing_appointment.doctor_id, existing_appointment.date_time)
+
     # Update the appointment
     existing_appointment.doctor_id = new_appointment.doctor_id
     existing_appointment.date_time = new_appointment.appointment_date
     existing_appointment.status = models.Status.PENDING
     
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Slot already booked")
     db.refresh(existing_appointment)
+    background_tasks.add_task(crud.mark_slot_booked, existing_appointment.doctor_id, existing_appointment.date_time)
     
     return {
         "message": "Appointment rescheduled successfully",
@@ -727,6 +871,9 @@ def reschedule_appointment(
 
 # ADDED: Uvicorn startup configuration with proxy headers support
 if __name__ == "__main__":
+    # spawned processes (utils.password_pool) import the parent's __main__ first;
+    # point them at password_hashing instead of re-running this whole module
+    __spec__ = importlib.util.find_spec("password_hashing")
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
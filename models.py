@@ -1,6 +1,6 @@
 from sqlalchemy.orm import mapped_column, Mapped, relationship
 from database import Base
-from sqlalchemy import String, ForeignKey, DateTime, Enum, JSON, UniqueConstraint, Text
+from sqlalchemy import String, ForeignKey, DateTime, Enum, JSON, UniqueConstraint, Text, Index, text, func
 from typing import List
 import enum
 from datetime import datetime, time
@@ -22,6 +22,9 @@ class Status(str, enum.Enum):
     REJECTED = 'rejected'
     ACCECPTED = 'accepted'
 
+# Enum columns store member names, so this matches PENDING and ACCECPTED appointments
+ACTIVE_APPOINTMENT_WHERE = "status IN ('PENDING', 'ACCECPTED')"
+
 
 
 class User(Base):
@@ -35,73 +38,84 @@ class User(Base):
     date_of_birth : Mapped[DateTime] = mapped_column(DateTime(timezone=True))
     medical_license : Mapped[str] = mapped_column(String(50),nullable=True)
 
+    # Collections are never lazy loaded: load them with selectinload/joinedload
+    # in the query that needs them. Deleting a user leaves the rows to the
+    # foreign keys' ON DELETE CASCADE instead of loading every collection.
     family_connections: Mapped[List["FamilyConnections"]] = relationship(
         back_populates="patient",
         foreign_keys="FamilyConnections.patient_id",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     related_as_family: Mapped[List["FamilyConnections"]] = relationship(
         back_populates="family_member",
         foreign_keys="FamilyConnections.family_member_id",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     sent_invitations: Mapped[List["FamilyInvitations"]] = relationship(
         back_populates="invited",
         foreign_keys="FamilyInvitations.inviter_id",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     received_invitations: Mapped[List["FamilyInvitations"]] = relationship(
         back_populates="invitee",
         foreign_keys="FamilyInvitations.invitee_id",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     family_member_permissions: Mapped[List["FamilyPermissions"]] = relationship(
         back_populates="family_member",
         foreign_keys="FamilyPermissions.family_member_id",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     patient_permissions: Mapped[List["FamilyPermissions"]] = relationship(
         back_populates="patient",
         foreign_keys="FamilyPermissions.patient_id",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     patient_appointments: Mapped[List['Appointments']] = relationship(
         back_populates='patient',
         foreign_keys='Appointments.patient_id',
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     doctor_appointments: Mapped[List['Appointments']] = relationship(
         back_populates='doctor',
         foreign_keys='Appointments.doctor_id',
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     vitals: Mapped[List['Vitals']] = relationship(
         back_populates='patient',
         foreign_keys='Vitals.patient_id',
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     doctor_for_patient: Mapped[List['Vitals']] = relationship(
         back_populates='doctor',
         foreign_keys='Vitals.doctor_id',
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
     availability_settings: Mapped[List["DoctorAvailability"]] = relationship(
         back_populates="doctor",
-        cascade="all, delete-orphan"
-    )
-
-    patient_permissions: Mapped[List["FamilyPermissions"]] = relationship(
-        "FamilyPermissions",
-        foreign_keys="FamilyPermissions.patient_id",  # ✅ String reference
-        back_populates="patient",
-        cascade="all, delete-orphan"
-    )
-    
-    family_member_permissions: Mapped[List["FamilyPermissions"]] = relationship(
-        "FamilyPermissions",
-        foreign_keys="FamilyPermissions.family_member_id",  # ✅ String reference
-        back_populates="family_member",
-        cascade="all, delete-orphan"
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True
     )
 
 
@@ -121,6 +135,7 @@ class FamilyConnections(Base):
 
     __table_args__ = (
         UniqueConstraint('patient_id', 'family_member_id', name='unique_relationship'),
+        Index('ix_family_connections_family_member_id', 'family_member_id'),
     )
 
 
@@ -162,6 +177,7 @@ class FamilyPermissions(Base):
     
     __table_args__ = (
         UniqueConstraint('patient_id', 'family_member_id', name='unique_patient_family_permissions'),
+        Index('ix_family_permissions_family_member_id', 'family_member_id'),
     )
 
 
@@ -174,10 +190,24 @@ class Appointments(Base):
     doctor_id : Mapped[int] = mapped_column(ForeignKey('users.id', ondelete="CASCADE"))
     date_time : Mapped[DateTime] = mapped_column(DateTime(timezone=True))
     status : Mapped[str] = mapped_column(Enum(Status), nullable=False)
+    # bumped on every ORM update, used for the calendar feed's Last-Modified/ETag
+    updated_at : Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
     patient : Mapped['User'] = relationship(back_populates='patient_appointments', foreign_keys=[patient_id])
     doctor : Mapped['User'] = relationship(back_populates='doctor_appointments', foreign_keys=[doctor_id])
 
+    # A slot can only hold one active (pending/accepted) appointment; rejected ones don't block rebooking
+    __table_args__ = (
+        Index(
+            'uq_appointments_active_slot', 'doctor_id', 'date_time',
+            unique=True,
+            postgresql_where=text(ACTIVE_APPOINTMENT_WHERE),
+            sqlite_where=text(ACTIVE_APPOINTMENT_WHERE),
+        ),
+        Index('ix_appointments_doctor_id_date_time', 'doctor_id', 'date_time'),
+        Index('ix_appointments_patient_id_date_time', 'patient_id', 'date_time'),
+    )
+
 
 # Update Vitals model
 class Vitals(Base):
@@ -200,6 +230,10 @@ class Vitals(Base):
     patient: Mapped['User'] = relationship(back_populates='vitals', foreign_keys=[patient_id])
     doctor: Mapped['User'] = relationship(back_populates='doctor_for_patient', foreign_keys=[doctor_id])
 
+    __table_args__ = (
+        Index('ix_vitals_patient_id_timestamp', 'patient_id', 'timestamp'),
+    )
+
 
 # Update ChatParticipant model
 class ChatParticipant(Base):
@@ -211,6 +245,7 @@ class ChatParticipant(Base):
     chat_room: Mapped["ChatRoom"] = relationship("ChatRoom", back_populates="participants")
     __table_args__ = (
         UniqueConstraint('chat_id', 'user_id', name='unique_chat_participant'),
+        Index('ix_chat_participants_user_id', 'user_id'),
     )
 
 
@@ -227,6 +262,10 @@ class ChatMessage(Base):
     # sender relationship optional:
     sender: Mapped["User"] = relationship("User", foreign_keys=[sender_id])
 
+    __table_args__ = (
+        Index('ix_chat_messages_chat_id_timestamp', 'chat_id', 'timestamp'),
+    )
+
 
 # Update DoctorAvailability model
 class DoctorAvailability(Base):
@@ -244,6 +283,10 @@ class DoctorAvailability(Base):
     
     doctor: Mapped["User"] = relationship(back_populates="availability_settings")
 
+    __table_args__ = (
+        Index('ix_doctor_availability_doctor_id_day_of_week', 'doctor_id', 'day_of_week'),
+    )
+
     
 class ChatRoom(Base):
     __tablename__ = "chat_rooms"
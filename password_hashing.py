@@ -0,0 +1,19 @@
+"""
+bcrypt hashing, run in utils.password_pool's worker processes.
+
+Worker processes are spawned, so they import this module (and, by default,
+the parent's __main__) from scratch; it must not import anything of the app.
+"""
+from passlib.context import CryptContext
+import os
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+
+# hashes with other rounds than BCRYPT_ROUNDS report needs_update, and are rehashed on login
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated = 'auto', bcrypt__rounds=BCRYPT_ROUNDS)
+
+def hash_password(password : str) -> str:
+    return pwd_context.hash(password)
+
+def verify_password(password : str, hashed_password : str) -> bool:
+    return pwd_context.verify(password, hashed_password)
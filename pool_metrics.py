@@ -0,0 +1,126 @@
+"""
+Connection pool telemetry for the database engines.
+
+Pool events keep the checked-out count and the age of every pooled
+connection; the pool classes below time each checkout, including the wait
+for a free connection, which no pool event covers. snapshot() is served by
+GET /admin/system/db-pool. Numbers are per worker process.
+"""
+from bisect import bisect_left
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+import os
+import threading
+import time as t
+
+# upper bounds in milliseconds, the last bucket is everything above
+WAIT_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+class PoolStats:
+    def __init__(self, name):
+        self.name = name
+        self.engine = None
+        self.wait_counts = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.closes = 0
+        self._connected_at = {}  # id(connection record) -> monotonic connect time
+        self._lock = threading.Lock()
+
+    def observe_wait(self, elapsed_ms):
+        with self._lock:
+            self.wait_counts[bisect_left(WAIT_BUCKETS_MS, elapsed_ms)] += 1
+            self.wait_total_ms += elapsed_ms
+            self.wait_max_ms = max(self.wait_max_ms, elapsed_ms)
+
+    def snapshot(self):
+        pool = self.engine.pool if self.engine is not None else None
+        now = t.monotonic()
+        with self._lock:
+            ages = [now - connected_at for connected_at in self._connected_at.values()]
+            buckets = {}
+            cumulative = 0
+            for bound, count in zip(WAIT_BUCKETS_MS + ["+Inf"], self.wait_counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            waits = sum(self.wait_counts)
+            return {
+                "name": self.name,
+                "pool_size": pool.size() if isinstance(pool, QueuePool) else None,
+                "checked_out": pool.checkedout() if isinstance(pool, QueuePool) else None,
+                # QueuePool.overflow() goes negative while the pool is not full yet
+                "overflow_in_use": max(pool.overflow(), 0) if isinstance(pool, QueuePool) else None,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "closes": self.closes,
+                "checkout_wait_ms": {
+                    "count": waits,
+                    "sum": round(self.wait_total_ms, 3),
+                    "max": round(self.wait_max_ms, 3),
+                    "avg": round(self.wait_total_ms / waits, 3) if waits else 0.0,
+                    "buckets": buckets,
+                },
+                "connection_age_seconds": {
+                    "open": len(ages),
+                    "max": round(max(ages), 1) if ages else 0.0,
+                    "avg": round(sum(ages) / len(ages), 1) if ages else 0.0,
+                },
+            }
+
+stats = {}  # engine name -> PoolStats
+
+class _TimedCheckout:
+    """Mixin timing QueuePool._do_get, i.e. the wait for (or creation of) a connection."""
+    def _do_get(self):
+        started = t.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self._stats.timeouts += 1
+            raise
+        finally:
+            self._stats.observe_wait((t.perf_counter() - started) * 1000)
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    _stats = PoolStats("unattached")
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    _stats = PoolStats("unattached")
+
+def instrument(engine, name):
+    """Collect stats for a (sync) engine's pool under name; for async engines pass engine.sync_engine."""
+    pool_stats = stats[name] = PoolStats(name)
+    pool_stats.engine = engine
+
+    @event.listens_for(engine, "engine_disposed")
+    def attach(engine):
+        # dispose() replaces the pool, point the new one at the same stats
+        if isinstance(engine.pool, _TimedCheckout):
+            engine.pool._stats = pool_stats
+    attach(engine)
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        with pool_stats._lock:
+            pool_stats.connects += 1
+            pool_stats._connected_at[id(connection_record)] = t.monotonic()
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_stats.checkouts += 1
+
+    def forget(dbapi_connection, connection_record):
+        with pool_stats._lock:
+            if pool_stats._connected_at.pop(id(connection_record), None) is not None:
+                pool_stats.closes += 1
+
+    event.listen(engine, "close", forget)
+    event.listen(engine, "invalidate", lambda dbapi_connection, connection_record, exception: forget(dbapi_connection, connection_record))
+    return pool_stats
+
+def snapshot():
+    return {"pid": os.getpid(), "pools": [pool_stats.snapshot() for pool_stats in stats.values()]}
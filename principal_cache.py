@@ -0,0 +1,86 @@
+"""
+Cache of the authenticated user behind auth.get_cached_user.
+
+Only the columns authorization needs (id, role, name, email) are cached, per
+user id, in two tiers: an in-process LRU with a short TTL in front of a Redis
+copy shared by every worker. A miss in both loads the user from the database.
+
+When a user is deleted or their account changes, invalidate() drops the Redis
+copy and publishes the id, so every worker drops its LRU entry as well. Both
+tiers also expire, as a safety net for a missed message.
+"""
+from redis.exceptions import RedisError
+import json
+import logging
+import os
+import local_cache
+import models
+
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", 30))    # seconds, in-process
+PRINCIPAL_REDIS_TTL = int(os.getenv("PRINCIPAL_REDIS_TTL", 300))   # seconds, shared copy
+PRINCIPAL_CACHE_MAX_ENTRIES = 10000
+INVALIDATION_CHANNEL = "principal_cache:invalidate"
+
+class CachedUser:
+    """Stands in for models.User in routes that only read id, role, name and email."""
+    __slots__ = ("id", "role", "name", "email")
+
+    def __init__(self, id : int, role, name : str, email : str):
+        self.id = id
+        self.role = models.UserRoles(role)  # str enum: compares equal to 'doctor' and UserRoles.DOCTOR
+        self.name = name
+        self.email = email
+
+    @classmethod
+    def from_user(cls, user : models.User):
+        return cls(user.id, user.role, user.name, user.email)
+
+    def to_json(self):
+        return json.dumps({"id": self.id, "role": self.role.value, "name": self.name, "email": self.email})
+
+    @classmethod
+    def from_json(cls, raw : str):
+        return cls(**json.loads(raw))
+
+cache = local_cache.GenerationalLRU(PRINCIPAL_CACHE_TTL, PRINCIPAL_CACHE_MAX_ENTRIES)  # user_id -> CachedUser
+
+def make_principal_key(user_id : int):
+    return f'principal:user:{user_id}'
+
+async def get_principal(redis_client, user_id : int, load):
+    """
+    The cached user, or await load() (returning a models.User or None) on a
+    miss. Redis being down only costs the database lookup.
+    """
+    principal = cache.get(user_id)
+    if principal is not None:
+        return principal
+
+    generation = cache.generation(user_id)
+    try:
+        raw = await redis_client.get(make_principal_key(user_id))
+    except RedisError as e:
+        logging.warning(f"Principal cache unavailable: {e}")
+        raw = None
+    if raw is not None:
+        principal = CachedUser.from_json(raw)
+    else:
+        user = await load()
+        if user is None:
+            return None
+        principal = CachedUser.from_user(user)
+        try:
+            await redis_client.set(make_principal_key(user_id), principal.to_json(), ex=PRINCIPAL_REDIS_TTL)
+        except RedisError as e:
+            logging.warning(f"Principal cache unavailable: {e}")
+    cache.put(user_id, principal, generation)
+    return principal
+
+async def invalidate(redis_client, user_id : int):
+    cache.invalidate(user_id)
+    await redis_client.delete(make_principal_key(user_id))
+    await local_cache.publish(redis_client, INVALIDATION_CHANNEL, {"user_id": user_id})
+
+async def listen_for_invalidations(redis_client):
+    """Apply invalidations published by other workers to this worker's cache."""
+    await local_cache.listen(redis_client, INVALIDATION_CHANNEL, lambda message: cache.invalidate(int(message['user_id'])))
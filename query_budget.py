@@ -0,0 +1,107 @@
+"""
+Per-request SQL statement counting.
+
+Every engine is instrumented with cursor events that add each statement and
+its time to the RequestQueries of the request being served (a context
+variable set by the count_queries middleware in main.py). At the end of the
+request, statement shapes (the SQL with literals stripped) executed
+QUERY_REPEAT_THRESHOLD or more times are logged as a suspected N+1, and a
+route declared with @max_queries(n) that ran more than n statements is
+logged as over budget. With QUERY_DEBUG=1 the counts are also returned in
+X-DB-Queries / X-DB-Time-Ms headers.
+
+In tests, the enforce_query_budgets fixture (tests/conftest.py) fails the
+test when a route goes over its budget.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import event
+import logging
+import os
+import re
+import time as t
+
+QUERY_DEBUG = os.getenv("QUERY_DEBUG", "0") == "1"
+QUERY_REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", 5))
+STATEMENT_START = "query_budget_start"
+
+class RequestQueries:
+    def __init__(self):
+        self.count = 0
+        self.time_ms = 0.0
+        self.shapes = Counter()
+
+    def add(self, statement, elapsed_ms):
+        self.count += 1
+        self.time_ms += elapsed_ms
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold = QUERY_REPEAT_THRESHOLD):
+        """Statement shapes run at least threshold times, most frequent first."""
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+current = ContextVar("request_queries", default=None)
+# called with (route path, budget, RequestQueries) when a route goes over its budget
+violation_hooks = []
+
+def statement_shape(statement):
+    """The statement with literals and IN lists collapsed, so per-row lookups compare equal."""
+    shape = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    shape = re.sub(r"\b\d+(\.\d+)?\b", "?", shape)
+    shape = re.sub(r"\(\s*(\?|%\(\w+\)s|:\w+)(\s*,\s*(\?|%\(\w+\)s|:\w+))*\s*\)", "(?)", shape)
+    return " ".join(shape.split())
+
+def instrument(engine):
+    """Count engine's statements into the current request (pass engine.sync_engine for async engines)."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(STATEMENT_START, []).append(t.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def finish(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info[STATEMENT_START].pop()
+        queries = current.get()
+        if queries is not None:
+            queries.add(statement, (t.perf_counter() - started) * 1000)
+
+    @event.listens_for(engine, "handle_error")
+    def failed(exception_context):
+        # no after_cursor_execute for a failed statement
+        connection = exception_context.connection
+        if connection is not None and connection.info.get(STATEMENT_START):
+            connection.info[STATEMENT_START].pop()
+
+@contextmanager
+def track():
+    """Count the statements run inside the block (including threadpool work started from it)."""
+    queries = RequestQueries()
+    token = current.set(queries)
+    try:
+        yield queries
+    finally:
+        current.reset(token)
+
+def max_queries(n):
+    """Declare a route's query budget; put it below the @app.get/@router.get line."""
+    def decorate(func):
+        func.query_budget = n
+        return func
+    return decorate
+
+def report(request, response, queries):
+    """Log suspected N+1s and budget overruns of a finished request, add the debug headers."""
+    route = request.scope.get("route")
+    path = getattr(route, "path", request.url.path)
+    for shape, n in queries.repeated():
+        logging.warning(f"Suspected N+1 in {request.method} {path}: {n}x {shape[:200]}")
+    budget = getattr(getattr(route, "endpoint", None), "query_budget", None)
+    if budget is not None and queries.count > budget:
+        logging.warning(f"{request.method} {path} ran {queries.count} queries, budget is {budget}")
+        for hook in violation_hooks:
+            hook(f"{request.method} {path}", budget, queries)
+    if QUERY_DEBUG:
+        response.headers["X-DB-Queries"] = str(queries.count)
+        response.headers["X-DB-Time-Ms"] = f"{queries.time_ms:.1f}"
+        if budget is not None:
+            response.headers["X-DB-Query-Budget"] = str(budget)
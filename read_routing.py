@@ -0,0 +1,60 @@
+"""
+Routes read-only endpoints to the read replicas (DATABASE_REPLICA_URLS).
+
+Replication lags a little, so a user who just wrote something is kept on the
+primary for PRIMARY_STICKY_SECONDS: every successful unsafe request (POST, PUT,
+PATCH, DELETE) by an authenticated user sets a short-lived Redis key, and
+get_read_db uses the primary while that key exists. Without replicas
+configured everything goes to the primary and Redis is not consulted.
+
+To try it locally, point DATABASE_URL and DATABASE_REPLICA_URLS at two SQLite
+files (e.g. sqlite:///./primary.db and sqlite:///./replica.db).
+"""
+from fastapi import Depends, HTTPException, Request
+from typing import Optional
+import os
+import auth
+import database
+import main
+
+PRIMARY_STICKY_SECONDS = int(os.getenv("PRIMARY_STICKY_SECONDS", 5))
+UNSAFE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+def make_sticky_key(user_id : int):
+    return f'db:primary_sticky:user:{user_id}'
+
+def request_user_id(request : Request) -> Optional[int]:
+    """User id from the bearer token, without touching the database."""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        user_id = auth.decode_claims(token)["id"]
+    except HTTPException:
+        return None
+    return int(user_id) if user_id is not None else None
+
+async def record_write(redis_client, request : Request, response):
+    """Keep the user on the primary for a while after a successful write."""
+    if not database.replicas or request.method not in UNSAFE_METHODS or response.status_code >= 400:
+        return
+    user_id = request_user_id(request)
+    if user_id is not None:
+        await redis_client.set(make_sticky_key(user_id), 1, ex=PRIMARY_STICKY_SECONDS)
+
+async def prefer_primary(request : Request) -> bool:
+    if not database.replicas:
+        # open_read_session falls back to the primary (or the SQLite reader) anyway
+        return False
+    user_id = request_user_id(request)
+    if user_id is None:
+        return False
+    return bool(await main.redis_client.exists(make_sticky_key(user_id)))
+
+def get_read_db(use_primary : bool = Depends(prefer_primary)):
+    """Like get_db, but on a read replica. Only for routes that never write."""
+    db = database.SessionLocal() if use_primary else database.open_read_session()
+    try:
+        yield db
+    finally:
+        db.close()
@@ -1,45 +1,167 @@
+"""
+Slot events for /ws/doctor/{doctor_id}/slots.
+
+A subscription starts with a snapshot of the free slots of the requested date,
+tagged with the doctor's current event sequence number, followed by deltas
+("reserved"/"freed") that each carry the next sequence number. Sequence numbers
+are assigned per doctor in Redis when the event is published, so they are the
+same on every worker. Clients apply a delta only if its seq is above the last
+one they applied.
+
+Each worker keeps the last SLOT_EVENT_HISTORY deltas per doctor; a client that
+reconnects with ?last_seq=N gets just the deltas after N from there instead of
+a new snapshot, as long as they are all still in the buffer.
+"""
 from fastapi import WebSocket, WebSocketDisconnect, APIRouter
-from typing import List
+from collections import defaultdict, deque
+from typing import List, Optional
 import json
-from datetime import datetime
+import logging
+import os
+from datetime import datetime, date
+from fanout import FanoutHub
+from database import AsyncSessionLocal
+import crud
+import main
 
 router = APIRouter()
 
+SLOT_EVENTS_CHANNEL = "slot_events"
+SLOT_EVENT_HISTORY = int(os.getenv("SLOT_EVENT_HISTORY", 256))  # deltas kept per doctor for resuming clients
+
+# Number the event with the doctor's next sequence number and publish it in one
+# step, so events reach the channel in sequence order.
+PUBLISH_SLOT_EVENT_LUA = """
+local message = cjson.decode(ARGV[1])
+message['seq'] = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', ARGV[2], cjson.encode(message))
+return message['seq']
+"""
+
+def make_seq_key(doctor_id: int):
+    return f'slot_events:seq:doctor:{doctor_id}'
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # topics are (doctor_id, date); date None means the socket watches every date of the doctor
+        self.hub = FanoutHub()
+        self.history = defaultdict(lambda: deque(maxlen=SLOT_EVENT_HISTORY))  # doctor_id -> recent deltas
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, doctor_id: int, day: Optional[date] = None):
+        """Accept and subscribe paused; call resume() on the result once the initial state is sent."""
         await websocket.accept()
-        self.active_connections.append(websocket)
+        return self.hub.subscribe((doctor_id, day), websocket, paused=True)
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def disconnect(self, websocket: WebSocket, doctor_id: int, day: Optional[date] = None):
+        self.hub.unsubscribe((doctor_id, day), websocket)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+    def subscribers(self, doctor_id: int, day: date):
+        return self.hub.subscribers([(doctor_id, None), (doctor_id, day)])
+
+    async def broadcast(self, doctor_id: int, day: date, message: str):
+        # only queues the message; each socket's writer task sends it
+        self.hub.publish([(doctor_id, None), (doctor_id, day)], message)
+
+    def record(self, message: dict):
+        self.history[message["doctor_id"]].append(message)
+
+    def missed_since(self, doctor_id: int, last_seq: int, current_seq: int) -> Optional[List[dict]]:
+        """
+        Deltas after last_seq still in this worker's buffer, or None if some of
+        them are gone and the client needs a snapshot instead. Deltas up to
+        current_seq that have not reached this worker yet are delivered through
+        the subscription, so they don't count as missing.
+        """
+        if last_seq > current_seq:
+            return None  # sequence was reset, the client's state is from before
+        if last_seq == current_seq:
+            return []
+        history = self.history.get(doctor_id)
+        if not history or history[0]["seq"] > last_seq + 1:
+            return None
+        missed = [message for message in history if message["seq"] > last_seq]
+        if any(message["seq"] != last_seq + 1 + i for i, message in enumerate(missed)):
+            return None
+        return missed
 
 manager = ConnectionManager()
 
 @router.websocket("/ws/doctor/{doctor_id}/slots")
-async def websocket_endpoint(websocket: WebSocket, doctor_id: int):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, doctor_id: int, app_date: Optional[date] = None,
+                             last_seq: Optional[int] = None):
+    """
+    Slot events for one doctor, optionally only for one date (?app_date=YYYY-MM-DD).
+    Pass ?last_seq=N when reconnecting to get only the deltas after N.
+    """
+    connection = await manager.connect(websocket, doctor_id, app_date)
     try:
+        # subscribed before reading the sequence: anything published after this
+        # read is already queued behind the initial state
+        current_seq = int(await main.redis_client.get(make_seq_key(doctor_id)) or 0)
+        missed = manager.missed_since(doctor_id, last_seq, current_seq) if last_seq is not None else None
+        if missed is not None:
+            for message in missed:
+                if app_date is None or datetime.fromisoformat(message["slot_time"]).date() == app_date:
+                    await websocket.send_json(message)
+        elif app_date is not None:
+            # short-lived session: the socket must not keep a pooled connection while it idles
+            async with AsyncSessionLocal() as db:
+                slots = await crud.get_doctor_free_slots(doctor_id, app_date, db)
+            await websocket.send_json({
+                "type": "snapshot",
+                "seq": current_seq,
+                "doctor_id": doctor_id,
+                "date": app_date.isoformat(),
+                "slots": [slot.isoformat() for slot in slots]
+            })
+        else:
+            # no date to snapshot, only tell the client where the deltas start
+            await websocket.send_json({"type": "sync", "seq": current_seq, "doctor_id": doctor_id})
+        connection.resume()
+
         while True:
             # Keep connection alive; clients don't necessarily need to send data
             await websocket.receive_text()
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        pass
+    finally:
+        # also on a failed send or Redis/DB error, not only a clean disconnect
+        manager.disconnect(websocket, doctor_id, app_date)
+
+
+async def notify_slot_update(message: dict):
+    """
+    Remember a published delta and send it to the sockets connected to this
+    worker only, see publish_slot_update.
+    """
+    manager.record(message)
+    slot_time = datetime.fromisoformat(message["slot_time"])
+    await manager.broadcast(message["doctor_id"], slot_time.date(), json.dumps(message))
 
 
-async def notify_slot_update(doctor_id: int, slot_time: datetime, action: str):
+async def publish_slot_update(redis_client, doctor_id: int, slot_time: datetime, action: str):
     """
     action: 'reserved' or 'freed'
+    Publish a slot event once for the whole cluster; every worker relays it
+    to its own sockets through listen_for_slot_updates.
     """
     message = {
+        "type": "delta",
         "doctor_id": doctor_id,
         "slot_time": slot_time.isoformat(),
         "action": action
     }
-    await manager.broadcast(json.dumps(message))
+    script = redis_client.register_script(PUBLISH_SLOT_EVENT_LUA)
+    return await script(keys=[make_seq_key(doctor_id)], args=[json.dumps(message), SLOT_EVENTS_CHANNEL])
+
+
+async def listen_for_slot_updates(redis_client):
+    pubsub = redis_client.pubsub()
+    await pubsub.subscribe(SLOT_EVENTS_CHANNEL)
+    async for message in pubsub.listen():
+        if message['type'] != 'message':
+            continue
+        try:
+            await notify_slot_update(json.loads(message['data']))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Ignoring malformed slot event: {e}")
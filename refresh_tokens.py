@@ -0,0 +1,113 @@
+"""
+Refresh tokens for renewing short-lived access tokens without a password check.
+
+A refresh token is `{family}.{secret}`. A login starts a family: the
+`refresh:family:{family}` hash holds the SHA-256 of the family's one valid
+token plus the claims to put in new access tokens (id, role, sub). Tokens
+themselves are never stored. Every refresh rotates the token: the presented
+one must be the family's current token and is replaced by a new one.
+
+Presenting an older token of a family means it was copied and already used,
+by the user or by someone else, so the whole family is revoked and both
+parties have to log in again. Families expire after REFRESH_TOKEN_EXPIRE_DAYS
+without a refresh. `refresh:user:{id}` lists a user's families, so all of
+them can be revoked at once.
+"""
+import hashlib
+import os
+import secrets
+
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 14))
+REFRESH_TOKEN_TTL = REFRESH_TOKEN_EXPIRE_DAYS * 24 * 60 * 60
+
+# Swap the family's current token hash (ARGV[1]) for a new one (ARGV[2]) and
+# return the claims; a stale hash revokes the family. 0 = unknown or expired
+# family, -1 = reuse detected.
+ROTATE_REFRESH_TOKEN_LUA = """
+local current = redis.call('HGET', KEYS[1], 'current')
+if not current then return 0 end
+if current ~= ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return -1
+end
+redis.call('HSET', KEYS[1], 'current', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return redis.call('HMGET', KEYS[1], 'id', 'role', 'sub')
+"""
+
+# Drop a family (KEYS[1]) and its entry in the user's list (KEYS[2]), only if
+# ARGV[1] is its current token hash and ARGV[2] the user it belongs to.
+REVOKE_REFRESH_TOKEN_LUA = """
+local family = redis.call('HMGET', KEYS[1], 'current', 'id')
+if family[1] ~= ARGV[1] or family[2] ~= ARGV[2] then return 0 end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[3])
+return 1
+"""
+
+class InvalidRefreshToken(Exception):
+    pass
+
+class RefreshTokenReused(InvalidRefreshToken):
+    pass
+
+def make_family_key(family : str):
+    return f'refresh:family:{family}'
+
+def make_user_families_key(user_id : int):
+    return f'refresh:user:{user_id}'
+
+def _digest(token : str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _new_token(family : str):
+    return f'{family}.{secrets.token_urlsafe(32)}'
+
+async def issue(redis_client, claims : dict) -> str:
+    """Start a family for a fresh login and return its first refresh token."""
+    family = secrets.token_urlsafe(16)
+    token = _new_token(family)
+    user_id = int(claims['id'])
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(make_family_key(family), mapping={
+            'current': _digest(token), 'id': user_id, 'role': str(claims['role']), 'sub': claims['sub']
+        })
+        pipe.expire(make_family_key(family), REFRESH_TOKEN_TTL)
+        pipe.sadd(make_user_families_key(user_id), family)
+        pipe.expire(make_user_families_key(user_id), REFRESH_TOKEN_TTL)
+        await pipe.execute()
+    return token
+
+async def rotate(redis_client, token : str):
+    """Trade a refresh token for (claims, next refresh token)."""
+    family, sep, _ = token.partition('.')
+    if not sep or not family:
+        raise InvalidRefreshToken()
+    new_token = _new_token(family)
+    script = redis_client.register_script(ROTATE_REFRESH_TOKEN_LUA)
+    result = await script(keys=[make_family_key(family)],
+                          args=[_digest(token), _digest(new_token), REFRESH_TOKEN_TTL])
+    if result == -1:
+        raise RefreshTokenReused()
+    if not result:
+        raise InvalidRefreshToken()
+    user_id, role, sub = result
+    return {'id': int(user_id), 'role': role, 'sub': sub}, new_token
+
+async def revoke(redis_client, token : str, user_id : int) -> bool:
+    """
+    Log one session out: drop the token's family. Only the family's current
+    token, presented by the user it was issued to, can do that.
+    """
+    family, sep, _ = token.partition('.')
+    if not sep or not family:
+        return False
+    script = redis_client.register_script(REVOKE_REFRESH_TOKEN_LUA)
+    revoked = await script(keys=[make_family_key(family), make_user_families_key(user_id)],
+                           args=[_digest(token), int(user_id), family])
+    return bool(revoked)
+
+async def revoke_user(redis_client, user_id : int):
+    """Drop every family of a user, e.g. when the account is deleted."""
+    families = await redis_client.smembers(make_user_families_key(user_id))
+    await redis_client.delete(make_user_families_key(user_id), *[make_family_key(family) for family in families])
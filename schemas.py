@@ -22,6 +22,9 @@ class PatientLogin(BaseModel):
     email : EmailStr
     password : str
 
+class RefreshTokenRequest(BaseModel):
+    refresh_token : str
+
 class UsersOut(BaseModel):
     id: int
     name: str
@@ -141,6 +144,13 @@ class AvailabilityItem(BaseModel):
 class SetAvailabilityRequest(BaseModel):
     availabilities: List[DoctorAvailability]
 
+class DoctorSchedule(BaseModel):
+    doctor_id: int
+    availabilities: List[DoctorAvailability]  # the doctor's whole week, missing weekdays are removed
+
+class BulkAvailabilityRequest(BaseModel):
+    schedules: List[DoctorSchedule]
+
 
 class AppointmentDetailOut(BaseModel):
     id: int
@@ -0,0 +1,67 @@
+"""
+In-process cache of computed free-slot lists per (doctor, date).
+
+Entries are dropped explicitly whenever a slot of that doctor changes (hold,
+booking, cancellation, expiry, availability edit). Invalidations are published
+on a Redis channel so every worker drops its copy, and entries also expire after
+SLOT_CACHE_TTL as a safety net for a missed message.
+
+Concurrent misses for the same key share one computation: the first request
+starts it as a task and every other request awaits that same task.
+"""
+import asyncio
+from datetime import date
+import local_cache
+
+SLOT_CACHE_TTL = 30  # seconds
+SLOT_CACHE_MAX_ENTRIES = 5000
+INVALIDATION_CHANNEL = "slot_cache:invalidate"
+
+class FreeSlotCache:
+    def __init__(self, ttl : int = SLOT_CACHE_TTL, max_entries : int = SLOT_CACHE_MAX_ENTRIES):
+        # (doctor_id, date) -> slots, invalidated per doctor
+        self._entries = local_cache.GenerationalLRU(ttl, max_entries, group_of=lambda key: key[0])
+        self._inflight = {}  # (doctor_id, date) -> asyncio.Task
+
+    async def get_or_compute(self, doctor_id : int, day : date, compute):
+        key = (doctor_id, day)
+        slots = self._entries.get(key)
+        if slots is not None:
+            return slots
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self._inflight[key] = task
+            generation = self._entries.generation(key)
+            task.add_done_callback(lambda done: self._store(key, generation, done))
+        # shield: one caller going away must not cancel the computation the others wait on
+        return await asyncio.shield(task)
+
+    def _store(self, key, generation, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries.put(key, task.result(), generation)
+
+    def invalidate(self, doctor_id : int, day : date = None):
+        """Drop one day of a doctor, or all of them when day is None."""
+        self._entries.invalidate(doctor_id, (doctor_id, day) if day is not None else None)
+        for key in [key for key in self._inflight if key[0] == doctor_id and day in (None, key[1])]:
+            del self._inflight[key]
+
+cache = FreeSlotCache()
+
+async def invalidate(redis_client, doctor_id : int, day : date = None):
+    cache.invalidate(doctor_id, day)
+    await local_cache.publish(redis_client, INVALIDATION_CHANNEL,
+                              {"doctor_id": doctor_id, "date": day.isoformat() if day else None})
+
+def _apply(message : dict):
+    day = date.fromisoformat(message['date']) if message.get('date') else None
+    cache.invalidate(int(message['doctor_id']), day)
+
+async def listen_for_invalidations(redis_client):
+    """Apply invalidations published by other workers to this worker's cache."""
+    await local_cache.listen(redis_client, INVALIDATION_CHANNEL, _apply)
@@ -0,0 +1,134 @@
+"""
+Slot holds and the per doctor/day hold registry.
+
+A hold is the `slot_hold:doctor:{id}:{iso}` key set with NX + TTL while a
+patient confirms a booking. Next to it we keep a sorted set per doctor and day
+(`slot_holds:doctor:{id}:{date}`) whose members are the held slot times scored
+by the hold's expiry, so the holds of a day are read with one ZRANGEBYSCORE
+instead of a KEYS scan over the whole keyspace.
+
+Every hold is also scheduled in one global sorted set (`slot_holds:expiries`)
+scored by its expiry. Workers sweep it and claim due holds atomically, so each
+expiry is handled by exactly one worker and none is lost while no worker is
+listening (unlike keyspace notifications).
+"""
+from datetime import date, datetime
+import time as t
+
+HOLD_EXPIRIES_KEY = "slot_holds:expiries"
+HOLD_CLAIM_BATCH = 100
+
+# Set the hold key, register it for its day and schedule its expiry in one
+# atomic step, only if the slot is not held yet. Scores use the Redis clock so
+# they line up with the key's TTL.
+RESERVE_HOLD_LUA = """
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then return 0 end
+local now = redis.call('TIME')
+local expires_at = tonumber(now[1]) + tonumber(now[2]) / 1000000 + tonumber(ARGV[2])
+redis.call('ZADD', KEYS[2], expires_at, ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+redis.call('ZADD', KEYS[3], expires_at, KEYS[1])
+return 1
+"""
+
+# Pop up to ARGV[1] holds whose expiry has passed. Runs atomically, so a hold
+# is returned to exactly one caller even with many workers sweeping.
+CLAIM_EXPIRED_HOLDS_LUA = """
+local now = redis.call('TIME')
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', tonumber(now[1]) + tonumber(now[2]) / 1000000, 'LIMIT', 0, tonumber(ARGV[1]))
+if #due > 0 then redis.call('ZREM', KEYS[1], unpack(due)) end
+return due
+"""
+
+def _normalize(slot_time : datetime):
+    return slot_time.replace(microsecond=0, tzinfo=None)
+
+def make_slot_key(doctor_id : int, slot_time : datetime):
+    normalized_dt = _normalize(slot_time)
+    raw =  f'slot_hold:doctor:{doctor_id}:{normalized_dt.isoformat()}'
+    return raw
+
+def make_hold_registry_key(doctor_id : int, day : date):
+    return f'slot_holds:doctor:{doctor_id}:{day.isoformat()}'
+
+def parse_slot_key(key : str):
+    # the ISO timestamp itself contains ':' so only split off the prefix
+    _, _, doctor_id, iso_dt = key.split(":", 3)
+    return int(doctor_id), datetime.fromisoformat(iso_dt)
+
+async def reserve_hold(redis_client, doctor_id : int, slot_time : datetime, user_id : int, ttl : int):
+    slot_time = _normalize(slot_time)
+    script = redis_client.register_script(RESERVE_HOLD_LUA)
+    reserved = await script(
+        keys=[make_slot_key(doctor_id, slot_time), make_hold_registry_key(doctor_id, slot_time.date()), HOLD_EXPIRIES_KEY],
+        args=[user_id, ttl, slot_time.isoformat()]
+    )
+    return bool(reserved)
+
+async def release_hold(redis_client, doctor_id : int, slot_time : datetime):
+    slot_time = _normalize(slot_time)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(make_slot_key(doctor_id, slot_time))
+        pipe.zrem(make_hold_registry_key(doctor_id, slot_time.date()), slot_time.isoformat())
+        pipe.zrem(HOLD_EXPIRIES_KEY, make_slot_key(doctor_id, slot_time))
+        await pipe.execute()
+
+async def get_held_times(redis_client, doctor_id : int, day : date):
+    registry_key = make_hold_registry_key(doctor_id, day)
+    now = t.time()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zremrangebyscore(registry_key, "-inf", now)
+        pipe.zrangebyscore(registry_key, now, "+inf")
+        _, members = await pipe.execute()
+    return {datetime.fromisoformat(m).time() for m in members}
+
+async def get_held_times_many(redis_client, doctor_ids, days):
+    """Holds for every (doctor, day) pair, fetched in one pipeline."""
+    pairs = [(doctor_id, day) for doctor_id in doctor_ids for day in days]
+    now = t.time()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for doctor_id, day in pairs:
+            pipe.zrangebyscore(make_hold_registry_key(doctor_id, day), now, "+inf")
+        results = await pipe.execute()
+    return {
+        pair: {datetime.fromisoformat(m).time() for m in members}
+        for pair, members in zip(pairs, results)
+    }
+
+# Check the holder and consume the hold (key + registry entry) atomically.
+# Returns -1 if there is no hold, 0 if it belongs to someone else, 1 once consumed.
+CONSUME_HOLD_LUA = """
+local holder = redis.call('GET', KEYS[1])
+if not holder then return -1 end
+if holder ~= ARGV[1] then return 0 end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[2])
+redis.call('ZREM', KEYS[3], KEYS[1])
+return 1
+"""
+
+async def check_hold(redis_client, doctor_id : int, slot_time : datetime, user_id : int):
+    """Same return values as consume_hold, without consuming the hold."""
+    holder = await redis_client.get(make_slot_key(doctor_id, slot_time))
+    if holder is None:
+        return -1
+    return 1 if str(holder) == str(user_id) else 0
+
+async def consume_hold(redis_client, doctor_id : int, slot_time : datetime, user_id : int):
+    slot_time = _normalize(slot_time)
+    script = redis_client.register_script(CONSUME_HOLD_LUA)
+    return await script(
+        keys=[make_slot_key(doctor_id, slot_time), make_hold_registry_key(doctor_id, slot_time.date()), HOLD_EXPIRIES_KEY],
+        args=[str(user_id), slot_time.isoformat()]
+    )
+
+async def claim_expired_holds(redis_client, limit : int = HOLD_CLAIM_BATCH):
+    """(doctor_id, slot_time) of the due holds this worker now owns; drops their registry entries."""
+    script = redis_client.register_script(CLAIM_EXPIRED_HOLDS_LUA)
+    claimed = [parse_slot_key(key) for key in await script(keys=[HOLD_EXPIRIES_KEY], args=[limit])]
+    if claimed:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for doctor_id, slot_time in claimed:
+                pipe.zrem(make_hold_registry_key(doctor_id, slot_time.date()), slot_time.isoformat())
+            await pipe.execute()
+    return claimed
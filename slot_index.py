@@ -0,0 +1,263 @@
+"""
+Per doctor/day slot index stored in Redis.
+
+Every indexed day is one string value: an 8 character header holding the
+first slot start (HHMM) and the appointment duration in minutes (4 digits),
+followed by one state character per slot of the working day. Reading the free
+slots for a day is a single GET; reservations, bookings and cancellations patch
+a single character in place (SETRANGE) instead of rebuilding the day.
+
+An index is built lazily from DoctorAvailability + appointments + holds the
+first time a day is read, and dropped whenever the doctor's availability
+changes so the next read rebuilds it with the new layout.
+
+Month summaries (free-slot count per day, for date pickers) are cached next to
+the day indexes and dropped by the same updates that touch a slot of that month.
+
+Both are built from a snapshot of the database and the holds, so an update
+landing while a build runs would be lost if the build stored its result
+afterwards. Every update bumps a version counter of its day and month (and
+invalidate_doctor one of the doctor); a build reads the counters first and
+only stores its result if none of them moved in the meantime.
+"""
+from datetime import date, datetime, time, timedelta
+from typing import List, Optional
+from collections import defaultdict
+import calendar
+import json
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+import models
+import slot_holds
+
+SLOT_INDEX_TTL = 15 * 60  # rebuilt from the DB at least every 15 minutes
+HEADER_LEN = 8
+EMPTY_DAY = "00000001"  # no working hours configured for this weekday
+
+FREE = "0"
+BOOKED = "B"
+HELD = "H"
+BREAK = "X"
+
+# Patch one slot of an existing index and drop the cached summary of its month
+# (KEYS[2]); bump the day and month versions (KEYS[3], KEYS[4]) so builds
+# running meanwhile don't store their snapshot. Returns 1 if the slot was
+# updated, 0 if its current state is not one of ARGV[3] and -1 if there is no
+# index for the day or the time is not on the slot grid.
+MARK_SLOT_LUA = """
+redis.call('DEL', KEYS[2])
+for i = 3, 4 do
+    redis.call('INCR', KEYS[i])
+    redis.call('EXPIRE', KEYS[i], ARGV[4])
+end
+local header = redis.call('GETRANGE', KEYS[1], 0, 7)
+if string.len(header) < 8 then return -1 end
+local start = tonumber(string.sub(header, 1, 2)) * 60 + tonumber(string.sub(header, 3, 4))
+local duration = tonumber(string.sub(header, 5, 8))
+local offset = tonumber(ARGV[1]) - start
+if offset < 0 or offset % duration ~= 0 then return -1 end
+local pos = 8 + offset / duration
+if pos >= redis.call('STRLEN', KEYS[1]) then return -1 end
+local current = redis.call('GETRANGE', KEYS[1], pos, pos)
+if current == 'X' then return -1 end
+if ARGV[3] ~= '' and not string.find(ARGV[3], current, 1, true) then return 0 end
+redis.call('SETRANGE', KEYS[1], pos, ARGV[2])
+return 1
+"""
+
+# Store a freshly built value (KEYS[1], NX) and register it in KEYS[2], only
+# if the versions KEYS[3..] still have the values ARGV[4..] read before the
+# build. Returns the stored value, or nil if a version moved.
+STORE_BUILT_LUA = """
+for i = 3, #KEYS do
+    if (redis.call('GET', KEYS[i]) or '0') ~= ARGV[i + 1] then return false end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2], 'NX')
+redis.call('SADD', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return redis.call('GET', KEYS[1])
+"""
+
+def make_index_key(doctor_id : int, day : date):
+    return f'slot_index:doctor:{doctor_id}:{day.isoformat()}'
+
+def make_index_days_key(doctor_id : int):
+    return f'slot_index:doctor:{doctor_id}:days'
+
+def make_month_key(doctor_id : int, year : int, month : int):
+    return f'slot_month:doctor:{doctor_id}:{year:04d}-{month:02d}'
+
+def make_month_set_key(doctor_id : int):
+    return f'slot_month:doctor:{doctor_id}:months'
+
+def make_day_version_key(doctor_id : int, day : date):
+    return f'slot_index:doctor:{doctor_id}:{day.isoformat()}:version'
+
+def make_month_version_key(doctor_id : int, year : int, month : int):
+    return f'slot_month:doctor:{doctor_id}:{year:04d}-{month:02d}:version'
+
+def make_doctor_version_key(doctor_id : int):
+    return f'slot_index:doctor:{doctor_id}:version'
+
+async def read_versions(redis_client, keys):
+    return [value or '0' for value in await redis_client.mget(keys)]
+
+async def store_built(redis_client, key : str, value : str, set_key : str, member : str, version_keys, versions):
+    """Store a built index or summary unless one of its versions moved since they were read; None if not stored."""
+    script = redis_client.register_script(STORE_BUILT_LUA)
+    return await script(keys=[key, set_key, *version_keys], args=[value, SLOT_INDEX_TTL, member, *versions])
+
+def day_of_week_number(day : date):
+    # DoctorAvailability.day_of_week uses Sunday=0 ... Saturday=6 (see doctor dashboard)
+    return (day.weekday() + 1) % 7
+
+def _minute_of_day(value : time):
+    return value.hour * 60 + value.minute
+
+def build_day_states(day : date, availability, booked_times, held_times):
+    """Render the index value for one day from its availability row and taken slots."""
+    if availability is None:
+        return EMPTY_DAY
+
+    booked = {_minute_of_day(t) for t in booked_times}
+    held = {_minute_of_day(t) for t in held_times}
+    break_start = availability.break_start
+    break_end = availability.break_end
+
+    states = []
+    current_time = datetime.combine(day, availability.start_time)
+    end_time = datetime.combine(day, availability.end_time)
+    while current_time < end_time:
+        slot_time = current_time.time()
+        minute = _minute_of_day(slot_time)
+        if break_start and break_end and break_start <= slot_time < break_end:
+            states.append(BREAK)
+        elif minute in booked:
+            states.append(BOOKED)
+        elif minute in held:
+            states.append(HELD)
+        else:
+            states.append(FREE)
+        current_time = current_time + timedelta(minutes=availability.appointment_duration)
+
+    header = f'{availability.start_time.strftime("%H%M")}{availability.appointment_duration:04d}'
+    return header + "".join(states)
+
+def free_slots_from_index(value : str) -> List[time]:
+    start = int(value[0:2]) * 60 + int(value[2:4])
+    duration = int(value[4:8])
+    free_slots = []
+    for i, state in enumerate(value[HEADER_LEN:]):
+        if state == FREE:
+            minute = start + i * duration
+            free_slots.append(time(minute // 60, minute % 60))
+    return free_slots
+
+async def build_index(redis_client, doctor_id : int, day : date, db : AsyncSession):
+    version_keys = [make_day_version_key(doctor_id, day), make_doctor_version_key(doctor_id)]
+    versions = await read_versions(redis_client, version_keys)
+
+    booked_times = (await db.scalars(select(models.Appointments.date_time).where(
+        models.Appointments.doctor_id == doctor_id,
+        models.Appointments.date_time >= datetime.combine(day, time.min),
+        models.Appointments.date_time < datetime.combine(day + timedelta(days=1), time.min),
+        models.Appointments.status.in_(['ACCECPTED', 'PENDING'])
+    ))).all()
+
+    availability = (await db.scalars(select(models.DoctorAvailability).where(
+        models.DoctorAvailability.doctor_id == doctor_id,
+        models.DoctorAvailability.day_of_week == day_of_week_number(day)
+    ).limit(1))).first()
+
+    held_times = await slot_holds.get_held_times(redis_client, doctor_id, day)
+    value = build_day_states(day, availability, [date_time.time() for date_time in booked_times], held_times)
+
+    # NX: a concurrent reader may have built it first, keep the one already patched in place.
+    # Not stored if a slot changed during the build; the next read builds it again.
+    stored = await store_built(redis_client, make_index_key(doctor_id, day), value,
+                               make_index_days_key(doctor_id), day.isoformat(), version_keys, versions)
+    return stored or value
+
+async def get_free_slots(redis_client, doctor_id : int, day : date, db : AsyncSession) -> List[time]:
+    value = await redis_client.get(make_index_key(doctor_id, day))
+    if value is None:
+        value = await build_index(redis_client, doctor_id, day, db)
+    return free_slots_from_index(value)
+
+async def mark_slot(redis_client, doctor_id : int, slot_time : datetime, state : str, only_from : str = ""):
+    """
+    Set the state of one slot in the day's index, if that day is indexed.
+    only_from restricts the transition to slots currently in one of those states
+    (e.g. freeing an expired hold must not free a slot that has since been booked).
+    """
+    slot_time = slot_time.replace(tzinfo=None)
+    script = redis_client.register_script(MARK_SLOT_LUA)
+    return await script(
+        keys=[make_index_key(doctor_id, slot_time.date()), make_month_key(doctor_id, slot_time.year, slot_time.month),
+              make_day_version_key(doctor_id, slot_time.date()), make_month_version_key(doctor_id, slot_time.year, slot_time.month)],
+        args=[_minute_of_day(slot_time.time()), state, only_from, SLOT_INDEX_TTL]
+    )
+
+async def invalidate_doctor(redis_client, doctor_id : int, days_of_week = None):
+    """
+    Drop the indexed days and month summaries of a doctor, e.g. after their working
+    hours changed. days_of_week (Sunday=0) limits it to the days on those weekdays;
+    month summaries are always dropped.
+    """
+    days_key = make_index_days_key(doctor_id)
+    months_key = make_month_set_key(doctor_id)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.smembers(days_key)
+        pipe.smembers(months_key)
+        days, months = await pipe.execute()
+    days = [date.fromisoformat(d) for d in days]
+    if days_of_week is not None:
+        days = [day for day in days if day_of_week_number(day) in days_of_week]
+    keys = [make_index_key(doctor_id, day) for day in days]
+    keys += [f'slot_month:doctor:{doctor_id}:{m}' for m in months]
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.incr(make_doctor_version_key(doctor_id))
+        pipe.expire(make_doctor_version_key(doctor_id), SLOT_INDEX_TTL)
+        if days_of_week is None:
+            pipe.delete(days_key)
+        elif days:
+            pipe.srem(days_key, *[day.isoformat() for day in days])
+        pipe.delete(months_key, *keys)
+        await pipe.execute()
+
+async def get_month_summary(redis_client, doctor_id : int, year : int, month : int, db : AsyncSession):
+    """Free-slot count for every day of a month, computed in one pass and cached until a slot in it changes."""
+    key = make_month_key(doctor_id, year, month)
+    cached = await redis_client.get(key)
+    if cached is not None:
+        return json.loads(cached)
+    version_keys = [make_month_version_key(doctor_id, year, month), make_doctor_version_key(doctor_id)]
+    versions = await read_versions(redis_client, version_keys)
+
+    days = [date(year, month, d) for d in range(1, calendar.monthrange(year, month)[1] + 1)]
+
+    schedules = {}
+    for availability in (await db.scalars(select(models.DoctorAvailability).where(
+        models.DoctorAvailability.doctor_id == doctor_id
+    ))).all():
+        schedules.setdefault(availability.day_of_week, availability)
+
+    booked = defaultdict(list)
+    for date_time in (await db.scalars(select(models.Appointments.date_time).where(
+        models.Appointments.doctor_id == doctor_id,
+        models.Appointments.date_time >= datetime.combine(days[0], time.min),
+        models.Appointments.date_time < datetime.combine(days[-1] + timedelta(days=1), time.min),
+        models.Appointments.status.in_(['ACCECPTED', 'PENDING'])
+    ))).all():
+        booked[date_time.date()].append(date_time.time())
+
+    held = await slot_holds.get_held_times_many(redis_client, [doctor_id], days)
+
+    summary = {}
+    for day in days:
+        states = build_day_states(day, schedules.get(day_of_week_number(day)), booked[day], held[(doctor_id, day)])
+        summary[day.isoformat()] = len(free_slots_from_index(states))
+
+    await store_built(redis_client, key, json.dumps(summary), make_month_set_key(doctor_id),
+                      f'{year:04d}-{month:02d}', version_keys, versions)
+    return summary
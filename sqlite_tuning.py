@@ -0,0 +1,111 @@
+"""
+Settings for running on the SQLite fallback in production (single node).
+
+Every SQLite connection enforces foreign keys (off by default in SQLite), which
+the ON DELETE CASCADE foreign keys and passive_deletes relationships rely on.
+
+SQLITE_WAL=1 opts in to the rest. Every connection is opened in WAL mode with
+a busy timeout, so readers never block the writer and a writer waits instead
+of failing with "database is locked". Reads go to a separate read-only engine
+(used by database.open_read_session when no replica is configured), and
+write transactions on the main sync engine are funneled through one
+process-wide queue: a transaction takes its turn before its first write
+statement and gives it back on commit/rollback, so writers of a worker queue
+up in order instead of spinning on the file lock.
+
+Not queued: other workers, and writes made through the aiosqlite engine
+(async routes such as /token and /confirm_slot). Waiting on the queue would
+block the event loop, so those writers rely on busy_timeout alone.
+"""
+from sqlalchemy import event
+import os
+import re
+import sqlite3
+import threading
+
+SQLITE_WAL = os.getenv("SQLITE_WAL", "0") == "1"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_WRITE_QUEUE_TIMEOUT = float(os.getenv("SQLITE_WRITE_QUEUE_TIMEOUT", 30))  # seconds
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",  # durable at checkpoints; safe with WAL
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA cache_size=-65536",    # 64 MB (negative = KiB)
+]
+
+WRITE_STATEMENT = re.compile(r"^\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b", re.IGNORECASE)
+HOLDS_WRITE_TURN = "sqlite_write_turn"
+
+class WriteQueue:
+    """First come, first served turn for write transactions within this process."""
+    def __init__(self, timeout = SQLITE_WRITE_QUEUE_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._turn = threading.Condition(self._lock)
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()  # tickets whose holder gave up waiting
+
+    def acquire(self):
+        with self._lock:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            if not self._turn.wait_for(lambda: self._serving == ticket, timeout=self.timeout):
+                # later writers can't be served until this ticket is skipped
+                self._abandoned.add(ticket)
+                self._advance(0)
+                raise sqlite3.OperationalError("database is locked (timed out waiting for the write queue)")
+
+    def release(self):
+        with self._lock:
+            self._advance(1)
+
+    def _advance(self, step):
+        self._serving += step
+        while self._serving in self._abandoned:
+            self._abandoned.discard(self._serving)
+            self._serving += 1
+        self._turn.notify_all()
+
+write_queue = WriteQueue()
+
+def is_sqlite_file(url):
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+def enforce_foreign_keys(engine):
+    """Turn on foreign key enforcement for every new connection of engine."""
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+def apply_pragmas(engine, read_only = False):
+    """Run the WAL pragmas on every new connection of engine (pass engine.sync_engine for async engines)."""
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in PRAGMAS:
+            cursor.execute(pragma)
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+def serialize_writes(engine, queue = write_queue):
+    """Make engine's write transactions take their turn in queue."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def take_turn(conn, cursor, statement, parameters, context, executemany):
+        if not conn.info.get(HOLDS_WRITE_TURN) and WRITE_STATEMENT.match(statement):
+            queue.acquire()
+            conn.info[HOLDS_WRITE_TURN] = True
+
+    def give_back(info):
+        if info.pop(HOLDS_WRITE_TURN, False):
+            queue.release()
+
+    event.listen(engine, "commit", lambda conn: give_back(conn.info))
+    event.listen(engine, "rollback", lambda conn: give_back(conn.info))
+    # safety net for a connection returned to the pool without commit/rollback events
+    event.listen(engine, "checkin", lambda dbapi_connection, connection_record: give_back(connection_record.info))
@@ -0,0 +1,126 @@
+"""
+Shared test setup. database.py builds its engines at import time, so the
+environment is pointed at a throwaway SQLite file before anything from the
+app is imported (load_dotenv does not override variables that are already
+set).
+"""
+from datetime import datetime
+from fastapi.testclient import TestClient
+import fakeredis
+import itertools
+import os
+import pytest
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix="telehealth-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TEST_DIR, 'app.db')}"
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("QUERY_DEBUG", "1")
+
+# main first: auth, crud and read_routing import it back
+import main
+
+# the request log is written to ./logs/telehealth.log, keep it out of the checkout
+os.makedirs(os.path.join(TEST_DIR, "logs"))
+os.chdir(TEST_DIR)
+
+_emails = itertools.count()
+
+@pytest.fixture(scope="session")
+def app_module():
+    main.redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    return main
+
+@pytest.fixture(scope="session")
+def _client(app_module):
+    with TestClient(app_module.app) as client:
+        yield client
+
+@pytest.fixture
+def client(_client, app_module):
+    """TestClient on a fresh (fake) Redis and empty in-process caches."""
+    import local_cache, principal_cache, slot_cache, token_cache
+    _client.portal.call(app_module.redis_client.flushall)
+    token_cache.cache = token_cache.VerifiedTokenCache()
+    principal_cache.cache = local_cache.GenerationalLRU(principal_cache.PRINCIPAL_CACHE_TTL,
+                                                        principal_cache.PRINCIPAL_CACHE_MAX_ENTRIES)
+    slot_cache.cache = slot_cache.FreeSlotCache()
+    return _client
+
+@pytest.fixture
+def redis(client, app_module):
+    """Run a Redis coroutine from a test: redis(lambda r: r.get(key))."""
+    return lambda call: client.portal.call(lambda: call(app_module.redis_client))
+
+@pytest.fixture
+def db(app_module):
+    from database import SessionLocal
+    session = SessionLocal()
+    yield session
+    session.close()
+
+@pytest.fixture
+def make_user(db):
+    import models, utils
+    def make(role="patient", password="pw", **fields):
+        user = models.User(
+            name=fields.pop("name", f"{role} {next(_emails)}"),
+            email=fields.pop("email", f"{role}{next(_emails)}@example.com"),
+            hashed_password=utils.hash_password(password),
+            role=role,
+            date_of_birth=datetime(1990, 1, 1),
+            **fields
+        )
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+        return user
+    return make
+
+@pytest.fixture
+def auth_headers():
+    import auth
+    def headers(user):
+        token = auth.create_access_token({"sub": user.email, "id": user.id, "role": user.role})
+        return {"Authorization": f"Bearer {token}"}
+    return headers
+
+@pytest.fixture
+def enforce_query_budgets():
+    """Fail the test if any request made during it went over its route's @max_queries budget."""
+    import query_budget
+    violations = []
+    hook = lambda route, budget, queries: violations.append(
+        f"{route}: {queries.count} queries, budget {budget}; repeated: {queries.repeated(2)}")
+    query_budget.violation_hooks.append(hook)
+    try:
+        yield violations
+    finally:
+        query_budget.violation_hooks.remove(hook)
+    if violations:
+        pytest.fail("Query budget exceeded:\n" + "\n".join(violations))
+
+@pytest.fixture
+def login(client):
+    """POST /token for a user made with make_user (password 'pw'), returns the response JSON."""
+    def log_in(user, password="pw"):
+        response = client.post("/token", data={"username": user.email, "password": password})
+        assert response.status_code == 200, response.text
+        return response.json()
+    return log_in
+
+@pytest.fixture
+def scheduled_doctor(make_user, db):
+    """A doctor working 09:00-12:00 every day in 15 minute slots."""
+    import models
+    from datetime import time
+    doctor = make_user("doctor", medical_license="LIC")
+    for day_of_week in range(7):
+        db.add(models.DoctorAvailability(doctor_id=doctor.id, day_of_week=day_of_week, start_time=time(9),
+                                         end_time=time(12), appointment_duration=15))
+    db.commit()
+    return doctor
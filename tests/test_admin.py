@@ -0,0 +1,20 @@
+import pytest
+import models
+
+@pytest.mark.parametrize("role", ["patient", "doctor"])
+def test_delete_user_in_a_chat_room(client, db, make_user, auth_headers, role):
+    admin = make_user("admin")
+    patient = make_user("patient")
+    doctor = make_user("doctor", medical_license="LIC")
+    room = models.ChatRoom(name="consult", created_by=admin.id, patient_id=patient.id, doctor_id=doctor.id)
+    db.add(room)
+    db.commit()
+    deleted_id, room_id = (patient if role == "patient" else doctor).id, room.id
+
+    response = client.delete(f"/admin/users/{deleted_id}", headers=auth_headers(admin))
+    assert response.status_code == 200
+
+    db.expire_all()
+    assert db.get(models.User, deleted_id) is None
+    room = db.get(models.ChatRoom, room_id)
+    assert getattr(room, f"{role}_id") is None
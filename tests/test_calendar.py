@@ -0,0 +1,31 @@
+from datetime import date, datetime, time, timedelta
+import models
+
+SLOT = datetime.combine(date.today() + timedelta(days=7), time(9, 15))
+
+def calendar(client, headers, etag = None):
+    if etag:
+        headers = {**headers, "If-None-Match": etag}
+    return client.get("/get_all_appointments", headers=headers)
+
+def test_status_change_in_the_same_second_changes_the_etag(client, scheduled_doctor, make_user, auth_headers, db):
+    patient = make_user("patient")
+    doctor_headers = auth_headers(scheduled_doctor)
+    appointment = client.post("/create_appointment", headers=auth_headers(patient),
+                              json={"doctor_id": scheduled_doctor.id, "appointment_date": SLOT.isoformat()}).json()
+
+    first = calendar(client, doctor_headers)
+    assert first.status_code == 200 and first.json()[0]["status"] == "pending"
+    assert calendar(client, doctor_headers, first.headers["ETag"]).status_code == 304
+
+    row = db.get(models.Appointments, appointment["id"])
+    updated_at = row.updated_at
+    client.put("/appointment_response", headers=doctor_headers, json={"appointment_id": appointment["id"], "action": "reject"})
+    # CURRENT_TIMESTAMP has one-second resolution on SQLite: same updated_at as before
+    db.expire_all()
+    db.query(models.Appointments).filter(models.Appointments.id == row.id).update(
+        {"updated_at": updated_at}, synchronize_session=False)
+    db.commit()
+    second = calendar(client, doctor_headers, first.headers["ETag"])
+    assert second.status_code == 200 and second.json()[0]["status"] == "rejected"
+    assert second.headers["ETag"] != first.headers["ETag"]
@@ -0,0 +1,91 @@
+import asyncio
+from fanout import FanoutHub, OverflowPolicy
+
+class FakeSocket:
+    """Records what is sent; sends block until unblock() or fail with `fail`."""
+    def __init__(self, blocked = False, fail = None):
+        self.sent = []
+        self.closed_with = None
+        self.fail = fail
+        self.gate = asyncio.Event()
+        if not blocked:
+            self.gate.set()
+
+    async def send_text(self, message):
+        await self.gate.wait()
+        if self.fail:
+            raise self.fail
+        self.sent.append(message)
+
+    async def send_json(self, message):
+        await self.send_text(message)
+
+    async def close(self, code = 1000):
+        self.closed_with = code
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_drop_oldest_keeps_the_newest_messages():
+    async def run():
+        hub = FanoutHub(max_queue=2, policy=OverflowPolicy.DROP_OLDEST)
+        socket = FakeSocket(blocked=True)
+        connection = hub.subscribe("topic", socket)
+        for i in range(5):
+            assert hub.publish(["topic"], f"m{i}") == 1
+        socket.gate.set()
+        await settle()
+        return socket, connection, hub
+
+    socket, connection, hub = asyncio.run(run())
+    assert socket.sent == ["m3", "m4"]
+    assert connection.dropped == 3 and not connection.closed
+    assert "topic" in hub.topics
+
+def test_disconnect_policy_closes_the_slow_consumer():
+    async def run():
+        hub = FanoutHub(max_queue=2, policy=OverflowPolicy.DISCONNECT)
+        slow, fast = FakeSocket(blocked=True), FakeSocket()
+        hub.subscribe("topic", slow)
+        hub.subscribe("topic", fast)
+        delivered = []
+        for i in range(4):
+            # the slow writer is stuck sending m0, the fast one keeps up
+            delivered.append(hub.publish(["topic"], f"m{i}"))
+            await settle()
+        return hub, slow, fast, delivered
+
+    hub, slow, fast, delivered = asyncio.run(run())
+    assert delivered == [2, 2, 2, 1]
+    assert slow.closed_with == 1013
+    assert fast.sent == ["m0", "m1", "m2", "m3"]
+    assert list(hub.topics["topic"]) == [fast]
+
+def test_failed_send_evicts_the_connection():
+    async def run():
+        hub = FanoutHub(max_queue=10)
+        broken, healthy = FakeSocket(fail=RuntimeError("connection reset")), FakeSocket()
+        connection = hub.subscribe("topic", broken)
+        hub.subscribe("topic", healthy)
+        hub.publish(["topic"], "first")
+        await settle()
+        return hub, connection, broken, healthy, hub.publish(["topic"], "second")
+
+    hub, connection, broken, healthy, delivered = asyncio.run(run())
+    assert connection.closed and broken.closed_with == 1000
+    assert list(hub.topics["topic"]) == [healthy]
+    assert delivered == 1
+
+def test_unsubscribe_removes_the_topic_without_closing_the_socket():
+    async def run():
+        hub = FanoutHub()
+        socket = FakeSocket()
+        hub.subscribe("topic", socket)
+        hub.unsubscribe("topic", socket)
+        hub.unsubscribe("topic", socket)
+        await settle()
+        return hub, socket
+
+    hub, socket = asyncio.run(run())
+    assert "topic" not in hub.topics and socket.closed_with is None
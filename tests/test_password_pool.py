@@ -0,0 +1,29 @@
+import asyncio
+import pytest
+import password_hashing
+from utils import PasswordPool
+
+def test_failures_are_counted_apart_from_completed_jobs():
+    pool = PasswordPool(workers=1, queue_limit=1)
+
+    async def run():
+        hashed = await pool.run(password_hashing.hash_password, "pw")
+        assert await pool.run(password_hashing.verify_password, "pw", hashed)
+        with pytest.raises(ValueError):
+            await pool.run(password_hashing.verify_password, "pw", "not a hash")
+
+    try:
+        asyncio.run(run())
+    finally:
+        pool.shutdown()
+    stats = pool.stats()
+    assert (stats["completed"], stats["failed"], stats["in_flight"]) == (2, 1, 0)
+    assert stats["avg_ms"] > 0
+
+def test_register_family_rejects_existing_email(client, make_user):
+    family = make_user("family")
+    response = client.post("/register_family", json={
+        "name": "Someone Else", "email": family.email, "password": "pw", "date_of_birth": "1990-01-01"
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"] == "family member already exists"
@@ -0,0 +1,46 @@
+from datetime import date
+import principal_cache
+from local_cache import GenerationalLRU
+
+def test_get_current_user_is_the_orm_row(client, make_user, auth_headers):
+    doctor = make_user("doctor", medical_license="LIC-1")
+    response = client.get("/user/me", headers=auth_headers(doctor))
+    assert response.status_code == 200
+    assert response.json()["medical_license"] == "LIC-1"
+    assert response.headers["X-DB-Queries"] == "1"
+
+def test_cached_user_skips_the_query_until_invalidated(client, app_module, make_user, auth_headers):
+    patient = make_user("patient")
+    headers = auth_headers(patient)
+
+    assert client.post("/ws-token", headers=headers).headers["X-DB-Queries"] == "1"
+    assert client.post("/ws-token", headers=headers).headers["X-DB-Queries"] == "0"
+
+    client.portal.call(principal_cache.invalidate, app_module.redis_client, patient.id)
+    assert client.post("/ws-token", headers=headers).headers["X-DB-Queries"] == "1"
+
+def test_value_loaded_before_an_invalidation_is_not_stored():
+    lru = GenerationalLRU(ttl=30, max_entries=10, group_of=lambda key: key[0])
+    generation = lru.generation((1, date(2025, 1, 6)))
+    lru.invalidate(1)
+    lru.put((1, date(2025, 1, 6)), ["stale"], generation)
+    assert lru.get((1, date(2025, 1, 6))) is None
+
+def test_invalidate_drops_one_key_or_the_whole_group():
+    lru = GenerationalLRU(ttl=30, max_entries=10, group_of=lambda key: key[0])
+    for key in [(1, "mon"), (1, "tue"), (2, "mon")]:
+        lru.put(key, key, lru.generation(key))
+
+    lru.invalidate(1, (1, "mon"))
+    assert lru.get((1, "mon")) is None and lru.get((1, "tue")) == (1, "tue")
+
+    lru.invalidate(1)
+    assert lru.get((1, "tue")) is None and lru.get((2, "mon")) == (2, "mon")
+
+def test_lru_evicts_least_recently_used():
+    lru = GenerationalLRU(ttl=30, max_entries=2)
+    lru.put("a", 1, 0)
+    lru.put("b", 2, 0)
+    lru.get("a")
+    lru.put("c", 3, 0)
+    assert lru.get("b") is None and lru.get("a") == 1 and lru.get("c") == 3
@@ -0,0 +1,47 @@
+from fastapi import Depends
+from sqlalchemy.orm import Session
+import pytest
+import models
+from database import get_db
+from query_budget import max_queries
+
+@pytest.fixture
+def n_plus_one_route(app_module):
+    """A route that loads each doctor's availability one query at a time, over a budget of 2."""
+    @max_queries(2)
+    def doctors_with_availability(db : Session = Depends(get_db)):
+        doctors = db.query(models.User).filter(models.User.role == models.UserRoles.DOCTOR).all()
+        return {doctor.id: db.query(models.DoctorAvailability).filter(
+            models.DoctorAvailability.doctor_id == doctor.id).count() for doctor in doctors}
+
+    app_module.app.add_api_route("/test/doctors_with_availability", doctors_with_availability)
+    route = app_module.app.router.routes[-1]
+    yield route.path
+    app_module.app.router.routes.remove(route)
+
+def test_budgeted_routes_within_budget(client, make_user, auth_headers, enforce_query_budgets):
+    make_user("doctor")
+    patient = make_user("patient")
+
+    response = client.get("/all_doctors")
+    assert response.status_code == 200
+    assert int(response.headers["X-DB-Queries"]) <= int(response.headers["X-DB-Query-Budget"]) == 1
+
+    response = client.get("/get_vital", headers=auth_headers(patient))
+    assert response.status_code == 200
+    assert int(response.headers["X-DB-Queries"]) <= int(response.headers["X-DB-Query-Budget"])
+
+def test_n_plus_one_is_caught(client, make_user, n_plus_one_route, enforce_query_budgets):
+    for _ in range(3):
+        make_user("doctor")
+
+    response = client.get(n_plus_one_route)
+    assert response.status_code == 200
+    assert int(response.headers["X-DB-Queries"]) > 2
+
+    assert len(enforce_query_budgets) == 1
+    violation = enforce_query_budgets[0]
+    assert violation.startswith(f"GET {n_plus_one_route}: ")
+    assert "budget 2" in violation and "doctor_availability" in violation
+    # caught; don't fail this test for it
+    enforce_query_budgets.clear()
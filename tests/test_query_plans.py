@@ -0,0 +1,72 @@
+"""
+The hot queries must be served by the indexes declared in models.py.
+
+SQLite always runs; the PostgreSQL variant runs when TEST_DATABASE_URL points
+at a PostgreSQL database (its schema is created there and dropped afterwards).
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, select, text
+import os
+import pytest
+import models
+from database import Base
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+def hot_queries():
+    start = datetime(2025, 1, 6)
+    return {
+        "appointments by doctor and date range": select(models.Appointments).where(
+            models.Appointments.doctor_id == 1,
+            models.Appointments.date_time >= start,
+            models.Appointments.date_time < start + timedelta(days=7)
+        ),
+        "availability by doctor and day": select(models.DoctorAvailability).where(
+            models.DoctorAvailability.doctor_id == 1,
+            models.DoctorAvailability.day_of_week == 1
+        ),
+        "vitals by patient": select(models.Vitals).where(
+            models.Vitals.patient_id == 1
+        ).order_by(models.Vitals.timestamp.desc()),
+    }
+
+SQLITE_INDEXES = {
+    "appointments by doctor and date range": "ix_appointments_doctor_id_date_time",
+    "availability by doctor and day": "ix_doctor_availability_doctor_id_day_of_week",
+    "vitals by patient": "ix_vitals_patient_id_timestamp",
+}
+
+def compile_literal(engine, statement):
+    return str(statement.compile(engine, compile_kwargs={"literal_binds": True}))
+
+@pytest.fixture(scope="module")
+def sqlite_engine(tmp_path_factory):
+    engine = create_engine(f"sqlite:///{tmp_path_factory.mktemp('plans') / 'plans.db'}")
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.mark.parametrize("name", list(hot_queries()))
+def test_sqlite_uses_index(sqlite_engine, name):
+    with sqlite_engine.connect() as conn:
+        plan = conn.execute(text("EXPLAIN QUERY PLAN " + compile_literal(sqlite_engine, hot_queries()[name]))).all()
+    details = " | ".join(row[-1] for row in plan)
+    assert f"INDEX {SQLITE_INDEXES[name]}" in details, details
+
+@pytest.fixture(scope="module")
+def postgres_engine():
+    if not TEST_DATABASE_URL.startswith("postgresql"):
+        pytest.skip("TEST_DATABASE_URL is not a PostgreSQL database")
+    engine = create_engine(TEST_DATABASE_URL)
+    Base.metadata.create_all(engine)
+    yield engine
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+@pytest.mark.parametrize("name", list(hot_queries()))
+def test_postgres_uses_index(postgres_engine, name):
+    with postgres_engine.connect() as conn:
+        # empty tables would make a sequential scan the cheapest plan
+        conn.execute(text("SET enable_seqscan = off"))
+        plan = conn.execute(text("EXPLAIN " + compile_literal(postgres_engine, hot_queries()[name]))).scalars().all()
+    assert any("Index" in line for line in plan), "\n".join(plan)
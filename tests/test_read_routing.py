@@ -0,0 +1,57 @@
+"""
+Read routing against two SQLite files: the app's database as the primary and
+a second, empty one as its replica, so which one answered shows in the counts.
+"""
+from sqlalchemy import create_engine
+import pytest
+import database
+import read_routing
+from database import Base, ReplicaPool
+
+@pytest.fixture
+def replica(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(database, "replicas", ReplicaPool([engine], eject_seconds=30))
+    yield engine
+    engine.dispose()
+
+def total_users(client, headers):
+    response = client.get("/admin/users/stats", headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()["total_users"]
+
+def test_reads_go_to_the_replica(client, replica, make_user, auth_headers):
+    admin = make_user("admin")
+    assert total_users(client, auth_headers(admin)) == 0
+
+def test_write_makes_the_user_sticky_to_the_primary(client, replica, make_user, auth_headers, redis):
+    admin, other_admin, patient = make_user("admin"), make_user("admin"), make_user("patient")
+    headers = auth_headers(admin)
+    assert total_users(client, headers) == 0
+
+    assert client.delete(f"/admin/users/{patient.id}", headers=headers).status_code == 200
+    assert redis(lambda r: r.exists(read_routing.make_sticky_key(admin.id)))
+    assert total_users(client, headers) > 0
+
+    # other users keep reading from the replica
+    assert total_users(client, auth_headers(other_admin)) == 0
+
+def test_dead_replica_is_ejected_and_retried(tmp_path, monkeypatch):
+    dead = create_engine(f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    pool = ReplicaPool([dead], eject_seconds=30)
+    monkeypatch.setattr(database, "replicas", pool)
+    now = [1000.0]
+    monkeypatch.setattr(database.t, "monotonic", lambda: now[0])
+
+    db = database.open_read_session()
+    try:
+        assert db.get_bind() in (database.engine, database.sqlite_reader)
+    finally:
+        db.close()
+    assert pool.candidates() == []
+
+    now[0] += 29
+    assert pool.candidates() == []
+    now[0] += 1
+    assert pool.candidates() == [dead]
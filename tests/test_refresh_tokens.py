@@ -0,0 +1,56 @@
+import time
+import refresh_tokens
+
+def refresh(client, token):
+    return client.post("/token/refresh", json={"refresh_token": token})
+
+def test_refresh_rotates_the_token(client, make_user, login):
+    patient = make_user("patient")
+    first = login(patient)["refresh_token"]
+
+    response = refresh(client, first)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["user_id"] == patient.id and body["role"] == "patient"
+    second = body["refresh_token"]
+    assert second != first and second.split(".")[0] == first.split(".")[0]
+
+    # the new access token works
+    me = client.get("/user/me", headers={"Authorization": f"Bearer {body['access_token']}"})
+    assert me.status_code == 200 and me.json()["email"] == patient.email
+
+    assert refresh(client, second).status_code == 200
+
+def test_reuse_revokes_the_family(client, make_user, login, redis):
+    patient = make_user("patient")
+    first = login(patient)["refresh_token"]
+    second = refresh(client, first).json()["refresh_token"]
+
+    # the old token shows up again: someone else has a copy
+    response = refresh(client, first)
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Session revoked, log in again"
+    assert not redis(lambda r: r.exists(refresh_tokens.make_family_key(first.split(".")[0])))
+
+    # neither copy works any more
+    assert refresh(client, second).status_code == 401
+    assert refresh(client, first).status_code == 401
+
+def test_other_sessions_survive_a_reuse(client, make_user, login):
+    patient = make_user("patient")
+    stolen = login(patient)["refresh_token"]
+    other = login(patient)["refresh_token"]
+    refresh(client, stolen)
+    refresh(client, stolen)
+    assert refresh(client, other).status_code == 200
+
+def test_expired_family_is_rejected(client, make_user, login, monkeypatch):
+    monkeypatch.setattr(refresh_tokens, "REFRESH_TOKEN_TTL", 1)
+    token = login(make_user("patient"))["refresh_token"]
+    time.sleep(1.1)
+    response = refresh(client, token)
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Refresh token is invalid or expired"
+
+def test_malformed_token_is_rejected(client):
+    assert refresh(client, "no-family-separator").status_code == 401
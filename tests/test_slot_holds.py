@@ -0,0 +1,123 @@
+from datetime import date, datetime, time, timedelta
+from sqlalchemy.exc import OperationalError
+import asyncio
+import pytest
+import crud
+import models
+import realtime
+import slot_holds
+
+SLOT = datetime.combine(date.today() + timedelta(days=7), time(9, 15))
+
+def booking(doctor):
+    return {"doctor_id": doctor.id, "appointment_date": SLOT.isoformat()}
+
+def cancel(client, doctor, user):
+    return client.post("/cancel_slot", params={"doctor_id": doctor.id, "slot_time": SLOT.isoformat(), "user_id": user.id})
+
+def holder(redis, doctor):
+    return redis(lambda r: r.get(slot_holds.make_slot_key(doctor.id, SLOT)))
+
+def test_cancel_releases_only_your_own_hold(client, scheduled_doctor, make_user, redis):
+    patient, other = make_user("patient"), make_user("patient")
+    assert client.post("/reserve_slot", params={"user_id": other.id}, json=booking(scheduled_doctor)).status_code == 200
+
+    assert cancel(client, scheduled_doctor, patient).status_code == 404
+    assert holder(redis, scheduled_doctor) == str(other.id)
+
+    assert cancel(client, scheduled_doctor, other).status_code == 200
+    assert holder(redis, scheduled_doctor) is None
+    assert cancel(client, scheduled_doctor, other).status_code == 404
+
+def confirm(client, doctor, user):
+    return client.post("/confirm_slot", params={"user_id": user.id}, json=booking(doctor))
+
+def appointments(db, doctor):
+    db.expire_all()
+    return db.query(models.Appointments).filter(models.Appointments.doctor_id == doctor.id).all()
+
+def test_double_booking_is_a_conflict(client, scheduled_doctor, make_user, auth_headers, db):
+    patient, other = make_user("patient"), make_user("patient")
+    assert client.post("/create_appointment", headers=auth_headers(patient), json=booking(scheduled_doctor)).status_code == 200
+
+    # ON CONFLICT DO NOTHING returns no row
+    response = client.post("/create_appointment", headers=auth_headers(other), json=booking(scheduled_doctor))
+    assert response.status_code == 409
+
+    client.post("/reserve_slot", params={"user_id": other.id}, json=booking(scheduled_doctor))
+    assert confirm(client, scheduled_doctor, other).status_code == 409
+    assert len(appointments(db, scheduled_doctor)) == 1
+
+def test_a_hold_confirms_once(client, scheduled_doctor, make_user, db):
+    patient = make_user("patient")
+    client.post("/reserve_slot", params={"user_id": patient.id}, json=booking(scheduled_doctor))
+    assert confirm(client, scheduled_doctor, patient).status_code == 200
+    assert confirm(client, scheduled_doctor, patient).status_code == 410
+    assert len(appointments(db, scheduled_doctor)) == 1
+
+def test_hold_survives_a_failed_insert(client, scheduled_doctor, make_user, monkeypatch, redis, db):
+    patient = make_user("patient")
+    client.post("/reserve_slot", params={"user_id": patient.id}, json=booking(scheduled_doctor))
+
+    async def fail(*args, **kwargs):
+        raise OperationalError("INSERT", {}, Exception("database is locked"))
+    monkeypatch.setattr(crud, "async_book_appointment", fail)
+    with pytest.raises(OperationalError):
+        confirm(client, scheduled_doctor, patient)
+    assert holder(redis, scheduled_doctor) == str(patient.id)
+
+    monkeypatch.undo()
+    assert confirm(client, scheduled_doctor, patient).status_code == 200
+    assert holder(redis, scheduled_doctor) is None
+    assert len(appointments(db, scheduled_doctor)) == 1
+
+def test_accepting_a_rejected_appointment_after_a_rebooking_is_a_conflict(client, scheduled_doctor, make_user, auth_headers):
+    patient, other = make_user("patient"), make_user("patient")
+    appointment = client.post("/create_appointment", headers=auth_headers(patient), json=booking(scheduled_doctor)).json()
+    respond = lambda action: client.put("/appointment_response", headers=auth_headers(scheduled_doctor),
+                                        json={"appointment_id": appointment["id"], "action": action})
+    assert respond("reject").status_code == 200
+    assert client.post("/create_appointment", headers=auth_headers(other), json=booking(scheduled_doctor)).status_code == 200
+
+    response = respond("accept")
+    assert response.status_code == 409 and response.json()["detail"] == "Slot already booked"
+
+def expire(redis, doctor):
+    key = slot_holds.make_slot_key(doctor.id, SLOT)
+    redis(lambda r: r.delete(key))
+    redis(lambda r: r.zadd(slot_holds.HOLD_EXPIRIES_KEY, {key: 0}))
+
+@pytest.fixture
+def freed_events(monkeypatch):
+    events = []
+    async def publish(redis_client, doctor_id, slot_time, action):
+        if action == "freed":
+            events.append((doctor_id, slot_time, action))
+    monkeypatch.setattr(realtime, "publish_slot_update", publish)
+    return events
+
+def sweep_twice_concurrently(client, app_module):
+    async def sweep():
+        await asyncio.gather(app_module.free_expired_holds(), app_module.free_expired_holds())
+    client.portal.call(sweep)
+
+def test_one_expiry_gives_one_event_across_sweepers(client, app_module, scheduled_doctor, make_user, redis, freed_events):
+    patient = make_user("patient")
+    client.get("/available_appointment", params={"app_date": SLOT.date().isoformat(), "doctor_id": scheduled_doctor.id})
+    client.post("/reserve_slot", params={"user_id": patient.id}, json=booking(scheduled_doctor))
+    expire(redis, scheduled_doctor)
+
+    sweep_twice_concurrently(client, app_module)
+    sweep_twice_concurrently(client, app_module)
+    assert [event for event in freed_events if event[0] == scheduled_doctor.id] == [(scheduled_doctor.id, SLOT, "freed")]
+
+def test_no_freed_event_for_a_slot_booked_at_expiry(client, app_module, scheduled_doctor, make_user, redis, freed_events):
+    patient = make_user("patient")
+    client.get("/available_appointment", params={"app_date": SLOT.date().isoformat(), "doctor_id": scheduled_doctor.id})
+    client.post("/reserve_slot", params={"user_id": patient.id}, json=booking(scheduled_doctor))
+    assert confirm(client, scheduled_doctor, patient).status_code == 200
+    # the confirm's consume came too late to unschedule the expiry
+    redis(lambda r: r.zadd(slot_holds.HOLD_EXPIRIES_KEY, {slot_holds.make_slot_key(scheduled_doctor.id, SLOT): 0}))
+
+    sweep_twice_concurrently(client, app_module)
+    assert [event for event in freed_events if event[0] == scheduled_doctor.id] == []
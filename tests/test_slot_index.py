@@ -0,0 +1,145 @@
+from datetime import date, datetime, time, timedelta
+import asyncio
+import pytest
+import slot_holds
+import slot_cache
+import slot_index
+from database import AsyncSessionLocal
+
+DAY = date.today() + timedelta(days=7)
+SLOT = datetime.combine(DAY, time(9, 15))
+
+@pytest.fixture
+def doctor(scheduled_doctor):
+    return scheduled_doctor
+
+def free_slots(client, doctor):
+    response = client.get("/available_appointment", params={"app_date": DAY.isoformat(), "doctor_id": doctor.id})
+    assert response.status_code == 200
+    return response.json()
+
+def state(redis, doctor, slot_time = SLOT):
+    value = redis(lambda r: r.get(slot_index.make_index_key(doctor.id, slot_time.date())))
+    if value is None:
+        return None
+    return value[slot_index.HEADER_LEN + (slot_time.hour * 60 + slot_time.minute - 9 * 60) // 15]
+
+def booking(doctor, slot_time = SLOT):
+    return {"doctor_id": doctor.id, "appointment_date": slot_time.isoformat()}
+
+def test_hold_book_release(client, doctor, make_user, auth_headers, redis):
+    patient = make_user("patient")
+    assert "09:15:00" in free_slots(client, doctor)
+    assert state(redis, doctor) == slot_index.FREE
+
+    assert client.post("/reserve_slot", params={"user_id": patient.id}, json=booking(doctor)).status_code == 200
+    assert state(redis, doctor) == slot_index.HELD
+    assert "09:15:00" not in free_slots(client, doctor)
+
+    response = client.post("/confirm_slot", params={"user_id": patient.id}, json=booking(doctor))
+    assert response.status_code == 200
+    assert state(redis, doctor) == slot_index.BOOKED
+
+    appointment_id = client.get("/patient/appointments", headers=auth_headers(patient)).json()[0]["id"]
+    response = client.put("/appointment_response", headers=auth_headers(doctor),
+                          json={"appointment_id": appointment_id, "action": "reject"})
+    assert response.status_code == 200
+    assert state(redis, doctor) == slot_index.FREE
+    assert "09:15:00" in free_slots(client, doctor)
+
+def test_expired_hold_is_freed(client, doctor, make_user, redis):
+    patient = make_user("patient")
+    free_slots(client, doctor)
+    client.post("/reserve_slot", params={"user_id": patient.id}, json=booking(doctor))
+    assert state(redis, doctor) == slot_index.HELD
+
+    # let the hold run out now instead of after HOLD_TTL
+    key = slot_holds.make_slot_key(doctor.id, SLOT)
+    redis(lambda r: r.delete(key))
+    redis(lambda r: r.zadd(slot_holds.HOLD_EXPIRIES_KEY, {key: 0}))
+    for _ in range(30):
+        if state(redis, doctor) == slot_index.FREE:
+            break
+        client.portal.call(asyncio.sleep, 0.1)
+    assert state(redis, doctor) == slot_index.FREE
+
+def test_rebuild_matches_the_database_and_holds(client, doctor, make_user, redis):
+    patient, other = make_user("patient"), make_user("patient")
+    client.post("/reserve_slot", params={"user_id": patient.id}, json=booking(doctor))
+    client.post("/confirm_slot", params={"user_id": patient.id}, json=booking(doctor))
+    held = SLOT + timedelta(minutes=15)
+    client.post("/reserve_slot", params={"user_id": other.id}, json=booking(doctor, held))
+
+    redis(lambda r: r.delete(slot_index.make_index_key(doctor.id, DAY)))
+    slots = free_slots(client, doctor)
+    assert "09:15:00" not in slots and "09:30:00" not in slots and "09:00:00" in slots
+    assert state(redis, doctor) == slot_index.BOOKED
+    assert state(redis, doctor, held) == slot_index.HELD
+
+def test_update_during_a_build_is_not_lost(client, doctor, make_user, app_module, monkeypatch):
+    patient = make_user("patient")
+    get_held_times = slot_holds.get_held_times
+
+    async def hold_arrives_mid_build(redis_client, doctor_id, day):
+        # the snapshot is taken; now a hold lands while the day is not indexed yet
+        held = await get_held_times(redis_client, doctor_id, day)
+        await slot_holds.reserve_hold(redis_client, doctor_id, SLOT, patient.id, 60)
+        assert await slot_index.mark_slot(redis_client, doctor_id, SLOT, slot_index.HELD) == -1
+        return held
+    monkeypatch.setattr(slot_holds, "get_held_times", hold_arrives_mid_build)
+
+    async def build():
+        async with AsyncSessionLocal() as db:
+            return await slot_index.build_index(app_module.redis_client, doctor.id, DAY, db)
+    client.portal.call(build)
+    monkeypatch.undo()
+
+    # the stale snapshot was not stored, the next read sees the hold
+    assert "09:15:00" not in free_slots(client, doctor)
+
+def test_month_summary_is_not_stored_over_a_concurrent_update(client, doctor, make_user, app_module, monkeypatch, redis):
+    patient = make_user("patient")
+    get_held_times_many = slot_holds.get_held_times_many
+
+    async def hold_arrives_mid_build(redis_client, doctor_ids, days):
+        held = await get_held_times_many(redis_client, doctor_ids, days)
+        await slot_holds.reserve_hold(redis_client, doctor.id, SLOT, patient.id, 60)
+        await slot_index.mark_slot(redis_client, doctor.id, SLOT, slot_index.HELD)
+        return held
+    monkeypatch.setattr(slot_holds, "get_held_times_many", hold_arrives_mid_build)
+    params = {"doctor_id": doctor.id, "year": DAY.year, "month": DAY.month}
+    stale = client.get("/available_appointment/month", params=params).json()["days"][DAY.isoformat()]
+    monkeypatch.undo()
+
+    assert redis(lambda r: r.get(slot_index.make_month_key(doctor.id, DAY.year, DAY.month))) is None
+    assert client.get("/available_appointment/month", params=params).json()["days"][DAY.isoformat()] == stale - 1
+
+def test_accepting_a_rejected_appointment_books_the_slot_again(client, doctor, make_user, auth_headers, redis):
+    patient = make_user("patient")
+    client.post("/reserve_slot", params={"user_id": patient.id}, json=booking(doctor))
+    client.post("/confirm_slot", params={"user_id": patient.id}, json=booking(doctor))
+    appointment_id = client.get("/patient/appointments", headers=auth_headers(patient)).json()[0]["id"]
+
+    for action, listed in [("reject", True), ("accept", False)]:
+        response = client.put("/appointment_response", headers=auth_headers(doctor),
+                              json={"appointment_id": appointment_id, "action": action})
+        assert response.status_code == 200
+        assert ("09:15:00" in free_slots(client, doctor)) is listed
+    assert state(redis, doctor) == slot_index.BOOKED
+
+def test_cancelled_caller_does_not_fail_the_shared_computation(client):
+    cache = slot_cache.FreeSlotCache()
+
+    async def run():
+        release = asyncio.Event()
+        async def compute():
+            await release.wait()
+            return ["09:00"]
+        first = asyncio.ensure_future(cache.get_or_compute(1, DAY, compute))
+        second = asyncio.ensure_future(cache.get_or_compute(1, DAY, compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        return await second, first.cancelled()
+
+    assert client.portal.call(run) == (["09:00"], True)
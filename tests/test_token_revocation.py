@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+import auth
+import crud
+import refresh_tokens
+import token_cache
+
+def bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+def test_verified_token_is_served_from_the_lru(client, make_user, auth_headers, monkeypatch):
+    headers = auth_headers(make_user("patient"))
+    assert client.get("/get_vital", headers=headers).status_code == 200
+
+    def no_decode(*args, **kwargs):
+        raise AssertionError("token decoded again")
+    monkeypatch.setattr(auth.jwt, "decode", no_decode)
+    assert client.get("/get_vital", headers=headers).status_code == 200
+
+def test_logout_revokes_the_access_token(client, make_user, login):
+    patient = make_user("patient")
+    session = login(patient)
+    other_session = login(patient)
+
+    assert client.post("/logout", headers=bearer(session["access_token"])).status_code == 200
+
+    response = client.get("/get_vital", headers=bearer(session["access_token"]))
+    assert response.status_code == 401 and response.json()["detail"] == "Token has been revoked"
+    assert client.get("/get_vital", headers=bearer(other_session["access_token"])).status_code == 200
+
+def test_logout_revokes_only_its_own_refresh_token(client, make_user, login, redis):
+    patient, intruder = make_user("patient"), make_user("patient")
+    session = login(patient)
+    family = session["refresh_token"].split(".")[0]
+
+    # someone else's refresh token is left alone
+    intruder_session = login(intruder)
+    client.post("/logout", headers=bearer(intruder_session["access_token"]),
+                json={"refresh_token": session["refresh_token"]})
+    assert redis(lambda r: r.exists(refresh_tokens.make_family_key(family)))
+
+    client.post("/logout", headers=bearer(session["access_token"]), json={"refresh_token": session["refresh_token"]})
+    assert not redis(lambda r: r.exists(refresh_tokens.make_family_key(family)))
+    assert family not in redis(lambda r: r.smembers(refresh_tokens.make_user_families_key(patient.id)))
+    assert client.post("/token/refresh", json={"refresh_token": session["refresh_token"]}).status_code == 401
+
+def test_rotated_away_refresh_token_does_not_log_out(client, make_user, login, redis):
+    patient = make_user("patient")
+    session = login(patient)
+    rotated = client.post("/token/refresh", json={"refresh_token": session["refresh_token"]}).json()
+
+    client.post("/logout", headers=bearer(rotated["access_token"]), json={"refresh_token": session["refresh_token"]})
+    assert client.post("/token/refresh", json={"refresh_token": rotated["refresh_token"]}).status_code == 200
+
+def test_user_wide_revocation(client, make_user, auth_headers, login):
+    patient = make_user("patient")
+    old_headers = auth_headers(patient)
+    assert client.get("/get_vital", headers=old_headers).status_code == 200
+
+    client.portal.call(crud.invalidate_principal, patient.id)
+    assert client.get("/get_vital", headers=old_headers).status_code == 401
+
+    # logging in again right away works
+    session = login(patient)
+    assert client.get("/get_vital", headers=bearer(session["access_token"])).status_code == 200
+
+def test_revocation_is_compared_below_the_second(client, make_user, auth_headers, monkeypatch, app_module):
+    patient = make_user("patient")
+    monkeypatch.setattr(auth, "t", SimpleNamespace(time=lambda: 1_700_000_000.1))
+    before = auth_headers(patient)
+
+    monkeypatch.setattr(token_cache, "t", SimpleNamespace(time=lambda: 1_700_000_000.4))
+    client.portal.call(token_cache.revoke_user, app_module.redis_client, patient.id, 60)
+
+    # issued later within the same second as the revocation
+    monkeypatch.setattr(auth, "t", SimpleNamespace(time=lambda: 1_700_000_000.7))
+    after = auth_headers(patient)
+
+    monkeypatch.undo()
+    assert client.get("/get_vital", headers=before).status_code == 401
+    assert client.get("/get_vital", headers=after).status_code == 200
@@ -0,0 +1,76 @@
+"""
+Fast path for access token checks, and token revocation.
+
+Polling endpoints send the same token every few seconds, so tokens whose
+signature has been verified once are kept in a per-worker LRU (SHA-256 of the
+token -> claims) until their exp, and are not decoded and verified again.
+
+Revocation lives in Redis and costs one MGET per request:
+`revoked:jti:{jti}` revokes a single token (logout) until it would have
+expired anyway, and `revoked:user:{id}` holds a time before which every token
+issued to the user is invalid (account deleted, deactivated or changed).
+"""
+from collections import OrderedDict
+from redis.exceptions import RedisError
+import hashlib
+import logging
+import os
+import time as t
+
+JWT_CACHE_MAX_ENTRIES = int(os.getenv("JWT_CACHE_MAX_ENTRIES", 10000))
+
+class VerifiedTokenCache:
+    def __init__(self, max_entries : int = JWT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # token digest -> claims
+
+    def get(self, token : str):
+        digest = hashlib.sha256(token.encode()).digest()
+        claims = self._entries.get(digest)
+        if claims is None:
+            return None
+        if claims["exp"] <= t.time():
+            del self._entries[digest]
+            return None
+        self._entries.move_to_end(digest)
+        return claims
+
+    def put(self, token : str, claims : dict):
+        if "exp" not in claims:
+            return
+        self._entries[hashlib.sha256(token.encode()).digest()] = claims
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+cache = VerifiedTokenCache()
+
+def make_revoked_jti_key(jti : str):
+    return f'revoked:jti:{jti}'
+
+def make_revoked_user_key(user_id : int):
+    return f'revoked:user:{user_id}'
+
+async def is_revoked(redis_client, claims : dict) -> bool:
+    """Redis being down lets tokens through rather than failing every request."""
+    keys = [make_revoked_user_key(claims["id"])]
+    if claims.get("jti"):
+        keys.append(make_revoked_jti_key(claims["jti"]))
+    try:
+        values = await redis_client.mget(keys)
+    except RedisError as e:
+        logging.warning(f"Token revocation check unavailable: {e}")
+        return False
+    revoked_before = values[0]
+    if revoked_before is not None and claims.get("iat", 0) < float(revoked_before):
+        return True
+    return len(values) > 1 and values[1] is not None
+
+async def revoke_token(redis_client, claims : dict):
+    ttl = int(claims["exp"] - t.time())
+    if claims.get("jti") and ttl > 0:
+        await redis_client.set(make_revoked_jti_key(claims["jti"]), 1, ex=ttl)
+
+async def revoke_user(redis_client, user_id : int, ttl : int):
+    """Invalidate every token issued to the user so far; ttl is the longest access token lifetime."""
+    # fractional, like iat: tokens issued later in the same second stay valid
+    await redis_client.set(make_revoked_user_key(user_id), repr(t.time()), ex=ttl)
@@ -1,9 +1,84 @@
-from passlib.context import CryptContext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+import asyncio
+import multiprocessing
+import os
+import time as t
+from password_hashing import BCRYPT_ROUNDS, hash_password, pwd_context, verify_password
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated = 'auto')
+# bcrypt runs in its own processes, off the threadpool the sync routes share
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 2))           # processes per web worker
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", 64))  # jobs waiting for a process before 503
 
-def hash_password(password : str) -> str:
-    return pwd_context.hash(password)
+class PasswordPool:
+    """
+    Bounded process pool for password hashing. Counters are only touched
+    from the event loop, so they need no lock.
+    """
+    def __init__(self, workers = PASSWORD_WORKERS, queue_limit = PASSWORD_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_ms = 0.0  # of completed jobs
 
-def verify_password(password : str, hashed_password : str) -> bool:
-    return pwd_context.verify(password, hashed_password)
+    def executor(self):
+        # spawn, not fork: the web worker has threads and an event loop running.
+        # Jobs are password_hashing functions, which the processes import on their own.
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def run(self, func, *args):
+        if self.in_flight >= self.workers + self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(503, "Too many sign-ins in progress, try again shortly", headers={"Retry-After": "1"})
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        started = t.monotonic()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor(), func, *args)
+        except BrokenProcessPool:
+            self._executor = None  # a process died; start a fresh pool next time
+            self.failed += 1
+            raise
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        self.total_ms += (t.monotonic() - started) * 1000
+        return result
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "bcrypt_rounds": BCRYPT_ROUNDS,
+            "in_flight": self.in_flight,
+            "queued": max(self.in_flight - self.workers, 0),
+            "max_in_flight": self.max_in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_ms": round(self.total_ms / self.completed, 1) if self.completed else None,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_pool = PasswordPool()
+
+async def hash_password_async(password : str) -> str:
+    return await password_pool.run(hash_password, password)
+
+async def verify_password_async(password : str, hashed_password : str) -> bool:
+    return await password_pool.run(verify_password, password, hashed_password)